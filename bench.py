@@ -0,0 +1,106 @@
+import sys
+import os
+import os.path
+import time
+
+from fontmeta import FontMeta
+
+import main as client
+
+
+def walkFontPathsLegacy(fontDirs):
+    """The original os.walk based walker, kept for comparison"""
+
+    for fontDir in fontDirs:
+        for dirPath, subDirNames, fileNames in os.walk(fontDir):
+            for fileName in fileNames:
+                filePath = os.path.join(dirPath, fileName)
+                if(os.path.isfile(filePath)):
+                    root, ext = os.path.splitext(fileName)
+                    if(ext in ['.otf', '.ttf']):
+                        yield filePath
+
+
+def timeIt(label, func, repeat=5):
+    """Runs func repeat times and prints the best wall-clock time"""
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print(f"{label:<40} {best * 1000:10.2f} ms")
+    return res
+
+
+def benchWalk(fontDirs):
+    legacy = timeIt("walk: os.walk", lambda: sorted(walkFontPathsLegacy(fontDirs)))
+    def walkCold():
+        client.dirRecord = {}
+        return sorted(client.walkFontPaths(fontDirs))
+
+    current = timeIt("walk: parallel scandir", walkCold)
+
+    # Listings must be older than the racy window to be trusted
+    time.sleep(client.racyDirWindowNs / 10**9)
+    timeIt("walk: parallel scandir, unchanged dirs", lambda: sorted(client.walkFontPaths(fontDirs)))
+
+    # The new walker yields every file and leaves sniffing to getMeta()
+    if(not set(legacy) <= set(current)):
+        print("walk: fonts missing from the new walker!")
+
+    print(f"walk: {len(legacy)} fonts by extension, {len(current)} files")
+
+
+def readFontMetaLegacy(fontPath):
+    """Full FontMeta parse trimmed to the reported fields"""
+
+    fontMeta = FontMeta(fontPath).get_data()
+    return {key: fontMeta[key] for key in client.validMetaKeys if key in fontMeta}
+
+
+def benchNameTable(fontPaths):
+    """Times the mmap name table reader against FontMeta and cross-checks their output"""
+
+    def readAll(reader):
+        res = {}
+        for fontPath in fontPaths:
+            try:
+                res[fontPath] = reader(fontPath)
+            except Exception as e:
+                res[fontPath] = type(e).__name__
+        return res
+
+    legacy = timeIt("name: FontMeta", lambda: readAll(readFontMetaLegacy))
+    current = timeIt("name: mmap reader", lambda: readAll(client.readFontMeta))
+
+    mismatches = 0
+    for fontPath in fontPaths:
+        if(isinstance(current[fontPath], str)):
+            # Unsupported by the fast reader; extractMeta falls back to FontMeta
+            continue
+        # FontMeta knows nothing of named instances
+        fontMeta = {key: value for key, value in current[fontPath].items() if key != 'instances'}
+        if(fontMeta != legacy[fontPath]):
+            mismatches += 1
+            print(f"name: mismatch for '{fontPath}'")
+            print(f"    FontMeta: {legacy[fontPath]}")
+            print(f"    mmap:     {current[fontPath]}")
+
+    fallbacks = sum(isinstance(res, str) for res in current.values())
+    print(f"name: {len(fontPaths)} fonts, {fallbacks} fallbacks, {mismatches} mismatches")
+
+
+def main():
+
+    fontDirs = sys.argv[1:] or client.getFontDirs()
+    print(fontDirs)
+
+    benchWalk(fontDirs)
+    benchNameTable(sorted(walkFontPathsLegacy(fontDirs)))
+
+
+if(__name__ == '__main__'):
+    main()
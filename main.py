@@ -4,53 +4,2303 @@ import os.path
 import time
 import schedule
 import json
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import concurrent.futures
+import concurrent.futures.process
+import mmap
+import hashlib
+import zlib
+import multiprocessing
+import multiprocessing.connection
+import threading
+import subprocess
+import fnmatch
+import re
+import zipfile
+import itertools
+import collections
+
+try:
+    import pwd
+except ImportError:
+    # Windows has no user database; shared host mode is Unix only
+    pwd = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; sandboxed parsing then only has a deadline
+    resource = None
+
+from fontmeta import FontMeta, NAME_TABLE
+from fontTools.misc.encodingTools import getEncoding
 
-from fontmeta import FontMeta
+import openapi_client
+from openapi_client.api import default_api
+from openapi_client.model.font import Font
+
+metaRecordPath = 'meta_record.json'
+dirRecordPath = 'dir_record.json'
+failureRecordPath = 'failure_record.json'
+checkpointPath = 'scan_checkpoint.json'
+scanPolicyPath = 'scan_policy.json'
+
+# Seconds between saving the progress of a running scan
+checkpointInterval = 60
+
+# Upper bound on directories being listed concurrently while walking
+walkWorkers = 8
+
+# Whether symlinked directories are descended into while walking
+followLinks = False
+
+# Take the first scan's font list from fontconfig instead of walking, when
+# its caches are at least as new as the font directories
+bootstrapFromFontconfig = False
+fontconfigCacheDirs = ['/var/cache/fontconfig', '~/.cache/fontconfig']
+
+# Number of processes parsing fonts, None for one per CPU
+extractWorkers = None
+
+# Number of fonts handed to a worker process at a time
+extractChunkSize = 32
+
+# Parse every font in its own sandboxed worker with the limits below,
+# killing workers which exceed them
+isolateExtraction = False
+extractMemoryLimit = 1 << 30
+extractTimeout = 10
+
+# Number of files read at once from a spinning disk
+rotationalConcurrency = 1
+
+# {pathOnDevice: concurrency} overriding the detected limit of a device
+deviceConcurrency = {}
+
+# Budget for reading fonts during scans, None for unlimited
+scanBytesPerSecond = None
+scanFilesPerSecond = None
+
+# Ask the kernel to drop font pages from the page cache once read so scans
+# do not evict the cache of whatever else runs on the host
+dropCacheAfterRead = False
+
+# {fontPath: (statSignature, fontMeta)}, seeded from the meta record on first use
+metaCache = None
+
+# {statSignature: fontMeta} for the fonts in metaCache whose signature is
+# known, kept alongside it so aliases of a read file are found in one lookup
+signatureIndex = {}
+
+# Enough to hold the sfnt table directory of nearly every font
+fingerprintReadSize = 4096
+
+# First bytes of every font format we can read, by the kind of font
+fontMagic = {
+    b'\x00\x01\x00\x00': 'sfnt',
+    b'OTTO': 'sfnt',
+    b'true': 'sfnt',
+    b'ttcf': 'collection',
+    b'wOFF': 'woff',
+    b'PK\x03\x04': 'zip',
+}
+
+# {filePath: (statSignature, fontKind)} so each file is only sniffed once
+sniffCache = {}
+
+# {contentDigest: fontMeta} so identical files are parsed once
+digestIndex = {}
+
+# Digests of files found to be copies of another since the last full scan,
+# which logs each of them once
+sharedDigests = set()
+
+# Bytes hashed per update when digesting a file
+digestBlockSize = 1 << 20
+
+# {fontPath: {'signature', 'reason', 'failures', 'retryAt'}} for fonts which
+# failed to parse, loaded on first use
+failureRecord = None
+
+# A font which keeps failing is retried after at most this long once it changes
+failureRetryBaseSeconds = 30
+failureRetryMaxSeconds = 60 * 60
+
+# A font which changes while being read is read again this many times, after
+# waiting this many seconds each, before it is left for a later scan
+snapshotRetries = 2
+snapshotRetryDelay = 0.5
+
+# Changed paths are held until none has changed for quiescenceSeconds, so
+# files still being written and bursts of installs are reported at once,
+# but never for longer than quiescenceMaxHoldSeconds
+quiescenceSeconds = 2
+quiescenceMaxHoldSeconds = 60
+
+# Shared by the inotify loop and reportChanges(), created on first use
+changeDebouncer = None
+
+# Counts getMeta() calls, so that deferrals only hold for the scan making them
+scanGeneration = 0
+
+# {fontPath: scanGeneration} of fonts which kept changing while being read
+deferredPaths = {}
+
+# Created on first use and kept for the lifetime of the agent
+extractPool = None
+sandboxPool = None
+
+# When the running full scan was last checkpointed, None outside full scans
+lastCheckpoint = None
+
+# Files read per getMeta() call while streaming a scan
+streamBatchSize = 256
+
+# Fonts sent to the server per upsert by reportAll()
+reportChunkSize = 100
+
+# {(fontPath, faceIndex): family} as listed by fontconfig
+fontconfigFamilies = {}
+fontconfigBootstrapped = False
+
+# {st_dev: concurrency}, filled in as devices are seen
+deviceLimits = {}
+
+# Created on first use from scanBytesPerSecond and scanFilesPerSecond
+byteBucket = None
+fileBucket = None
+
+# {dirPath: {'mtime': ns, 'files': [names], 'dirs': [names]}}, loaded on first walk
+dirRecord = None
+
+# Directories modified this recently may still change within the same mtime
+# tick, so their listing is not trusted on the next walk
+racyDirWindowNs = 2 * 10**9
+
+# Scan the system font directories once for every user on the host, plus
+# each user's own font directories, reporting those under the user's name
+sharedHostMode = False
+
+# Accounts below this uid are system accounts and have no fonts of their own
+sharedHostMinUid = 1000
+
+# Enumerating the accounts may mean a round trip to a directory service, so
+# the list is only refreshed this often
+hostUsersRefreshSeconds = 60 * 60
+hostUsers = None
+hostUsersRead = None
+
+# {fontDir: userName or None}, refreshed by every getFontDirs() call
+fontDirOwners = None
+
+# Scan policy, overridden by scan_policy.json when present:
+# extra directories walked besides the discovered ones
+scanRoots = []
+
+# Glob patterns matched against full paths; excluded directories are never
+# descended into, and with include patterns only matching files are read
+includeGlobs = []
+excludeGlobs = []
+
+# Levels of subdirectories walked below a font directory, None for unlimited
+maxScanDepth = None
+
+# Files larger than this many bytes are never read, None for unlimited
+maxFontSize = None
+
+# (includeMatcher, excludeMatcher) compiled from the globs on first use
+pathMatchers = None
+
+
+def getSystemFontDirs():
+    """Returns a list of directories in which fonts shared by all users may exist"""
+
+    res = []
+    if(sys.platform.startswith('linux')):
+        dataDirs = os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share'
+        res = [os.path.join(dataDir, 'fonts') for dataDir in dataDirs.split(':') if dataDir]
+        res += ['/usr/share/fonts', '/usr/local/share/fonts']
+    elif(sys.platform.startswith('win32')):
+        res = ['C:\\Windows\\Fonts']
+    elif(sys.platform.startswith('darwin')):
+        res = ['/Library/Fonts']
+
+    return res
+
+
+def getUserFontDirs(homeDir):
+    """Returns a list of directories in which fonts of the user with the given home may exist"""
+
+    res = []
+    if(sys.platform.startswith('linux')):
+        # XDG_DATA_HOME only applies to the user running the agent
+        dataHome = os.path.join(homeDir, '.local', 'share')
+        if(homeDir == os.path.expanduser('~')):
+            dataHome = os.environ.get('XDG_DATA_HOME') or dataHome
+
+        res = [os.path.join(dataHome, 'fonts'),
+               os.path.join(homeDir, '.fonts'),
+               os.path.join(homeDir, 'fonts')]
+    elif(sys.platform.startswith('win32')):
+        res = [os.path.join(homeDir, 'AppData', 'Local', 'Microsoft', 'Windows', 'Fonts')]
+    elif(sys.platform.startswith('darwin')):
+        res = [os.path.join(homeDir, 'Library', 'Fonts')]
+
+    return res
+
+
+def getHostUsers():
+    """Returns {userName: homeDir} for the login users of this host
+
+    Only accounts getpwall() enumerates are covered: with LDAP or SSSD set
+    not to enumerate, network users are left out until they are listed."""
+
+    global hostUsers
+    global hostUsersRead
+
+    if(pwd is None):
+        return {}
+
+    now = time.monotonic()
+    if(hostUsers is None or now - hostUsersRead >= hostUsersRefreshSeconds):
+        hostUsers = {entry.pw_name: entry.pw_dir for entry in pwd.getpwall()
+                     if entry.pw_uid >= sharedHostMinUid and entry.pw_uid != 65534}
+        hostUsersRead = now
+
+    # Homes are created and removed independently of the account list
+    return {userName: homeDir for userName, homeDir in hostUsers.items()
+            if os.path.isdir(homeDir)}
+
+
+def getFontDirOwners():
+    """Returns {fontDir: userName} for every existing font directory, with
+    None as the owner of system directories
+
+    Directories are deduplicated by their real path, and directories below
+    another font directory are left out since they are walked anyway."""
+
+    candidates = [(fontDir, None) for fontDir in getSystemFontDirs()]
+    candidates += [(os.path.expanduser(fontDir), None) for fontDir in scanRoots]
+
+    if(sharedHostMode):
+        for userName, homeDir in getHostUsers().items():
+            candidates += [(fontDir, userName) for fontDir in getUserFontDirs(homeDir)]
+    else:
+        candidates += [(fontDir, None) for fontDir in getUserFontDirs(os.path.expanduser('~'))]
+
+    owners = {}
+    realDirs = {}
+    for fontDir, owner in candidates:
+        if(not os.path.isdir(fontDir)):
+            continue
+
+        realDir = os.path.realpath(fontDir)
+        if(realDir not in realDirs):
+            realDirs[realDir] = fontDir
+            owners[fontDir] = owner
+
+    for realDir, fontDir in realDirs.items():
+        for otherDir in realDirs:
+            if(realDir.startswith(os.path.join(otherDir, ''))):
+                del owners[fontDir]
+                break
+
+    return owners
+
+
+def getFontDirs():
+    """Returns a list of directories in which fonts may exist"""
+
+    global fontDirOwners
+
+    fontDirOwners = getFontDirOwners()
+    return list(fontDirOwners)
+
+
+def getFontUser(path, defaultUser):
+    """Returns the user a font is reported for: the owner of the font
+    directory it is in, or defaultUser for system fonts"""
+
+    global fontDirOwners
+
+    if(not sharedHostMode):
+        return defaultUser
+
+    if(fontDirOwners is None):
+        fontDirOwners = getFontDirOwners()
+
+    owner = None
+    ownerDir = ''
+    for fontDir, dirOwner in fontDirOwners.items():
+        if(path.startswith(os.path.join(fontDir, '')) and len(fontDir) > len(ownerDir)):
+            owner = dirOwner
+            ownerDir = fontDir
+
+    return owner or defaultUser
+
+
+def readScanPolicy():
+    try:
+
+        with open(scanPolicyPath, 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+
+def applyScanPolicy():
+    """Overrides the scan settings with those given in the scan policy file"""
+
+    global scanRoots
+    global includeGlobs
+    global excludeGlobs
+    global maxScanDepth
+    global followLinks
+    global maxFontSize
+    global pathMatchers
+
+    policy = readScanPolicy()
+
+    scanRoots = policy.get('roots', scanRoots)
+    includeGlobs = policy.get('include', includeGlobs)
+    excludeGlobs = policy.get('exclude', excludeGlobs)
+    maxScanDepth = policy.get('maxDepth', maxScanDepth)
+    followLinks = policy.get('followSymlinks', followLinks)
+    maxFontSize = policy.get('maxFileSize', maxFontSize)
+
+    pathMatchers = None
+
+
+def compileGlobs(patterns):
+    """Returns a single regex matching a path if any of the glob patterns
+    does, or None if there are no patterns"""
+
+    if(not patterns):
+        return None
+
+    return re.compile('|'.join(fnmatch.translate(os.path.expanduser(pattern))
+                               for pattern in patterns))
+
+
+def getPathMatchers():
+    global pathMatchers
+
+    if(pathMatchers is None):
+        pathMatchers = (compileGlobs(includeGlobs), compileGlobs(excludeGlobs))
+
+    return pathMatchers
+
+
+def isExcludedDir(dirPath):
+    """Returns whether an exclude pattern matches the directory, given either
+    as itself or with a trailing separator so '*/backup/*' prunes 'backup'"""
+
+    includeMatcher, excludeMatcher = getPathMatchers()
+
+    if(excludeMatcher is None):
+        return False
+
+    return (excludeMatcher.match(dirPath) is not None or
+            excludeMatcher.match(os.path.join(dirPath, '')) is not None)
+
+
+def isScannedFile(filePath):
+    """Returns whether the scan policy lets the file be read"""
+
+    includeMatcher, excludeMatcher = getPathMatchers()
+
+    if(excludeMatcher is not None and excludeMatcher.match(filePath)):
+        return False
+
+    return includeMatcher is None or includeMatcher.match(filePath) is not None
+
+
+def isWithinPolicy(filePath):
+    """Returns whether the scan policy lets a file found other than by
+    walking be read, just as walkFontPaths() would have yielded it"""
+
+    if(not isScannedFile(filePath)):
+        return False
+
+    dirPath = os.path.dirname(filePath)
+    depth = getDirDepth(dirPath)
+    if(maxScanDepth is not None and depth > maxScanDepth):
+        return False
+
+    # No directory on the way down from the font directory may be excluded
+    for i in range(depth + 1):
+        if(isExcludedDir(dirPath)):
+            return False
+        dirPath = os.path.dirname(dirPath)
+
+    return True
+
+
+def getDirDepth(dirPath):
+    """Returns how many levels below its font directory a directory is"""
+
+    for fontDir in fontDirOwners or ():
+        prefix = os.path.join(fontDir, '')
+        if(dirPath.startswith(prefix)):
+            return dirPath[len(prefix):].rstrip(os.sep).count(os.sep) + 1
+
+    return 0
+
+
+class TokenBucket:
+    """Makes callers wait so that on average at most rate units are taken per second
+
+    Taking more than is available puts the bucket in debt, so single large
+    takes are allowed but paid for with a proportionally longer wait."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if(wait > 0):
+            time.sleep(wait)
+
+
+def throttleRead(fileCount, byteCount):
+    """Waits until the scan budget allows opening and reading the given amount"""
+
+    global byteBucket
+    global fileBucket
+
+    if(scanFilesPerSecond):
+        if(fileBucket is None):
+            fileBucket = TokenBucket(scanFilesPerSecond)
+        fileBucket.take(fileCount)
+
+    if(scanBytesPerSecond):
+        if(byteBucket is None):
+            byteBucket = TokenBucket(scanBytesPerSecond)
+        byteBucket.take(byteCount)
+
+
+def dropPageCache(fd):
+    """Tells the kernel the file's pages will not be needed again, if configured to"""
+
+    if(dropCacheAfterRead and hasattr(os, 'posix_fadvise')):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def readMagic(filePath):
+    """Returns the first four bytes of a file with a single read"""
+
+    throttleRead(1, 4)
+
+    fd = os.open(filePath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if(hasattr(os, 'pread')):
+            return os.pread(fd, 4, 0)
+        return os.read(fd, 4)
+    finally:
+        dropPageCache(fd)
+        os.close(fd)
+
+
+def sniffFont(filePath, signature):
+    """Returns the kind of font held in a file from its magic bytes, or None if it is not a font"""
+
+    cached = sniffCache.get(filePath)
+    if(cached is not None and cached[0] == signature):
+        return cached[1]
+
+    try:
+        fontKind = fontMagic.get(readMagic(filePath))
+    except OSError:
+        fontKind = None
+
+    sniffCache[filePath] = (signature, fontKind)
+    return fontKind
+
+
+def scanDir(dirPath, known=None):
+    """Returns ((st_dev, st_ino), listing) for a directory, where listing is
+    {'mtime', 'files', 'dirs'} or None if the directory is unreadable
+
+    The known listing is reused without reading the directory when the
+    directory's mtime shows no entries have been added, removed or renamed."""
+
+    try:
+        st = os.stat(dirPath)
+    except OSError:
+        return None, None
+
+    identity = (st.st_dev, st.st_ino)
+    mtime = st.st_mtime_ns
+
+    if(known is not None and known['mtime'] == mtime and 'files' in known):
+        return identity, known
+
+    fileNames = []
+    subDirNames = []
+
+    try:
+        with os.scandir(dirPath) as entries:
+            for entry in entries:
+                # DirEntry caches the type from readdir, so only symlinks
+                # cost an extra stat here
+                try:
+                    if(entry.is_dir(follow_symlinks=followLinks)):
+                        subDirNames.append(entry.name)
+                    elif(entry.is_file()):
+                        fileNames.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        # Same as os.walk: unreadable directories are skipped
+        return identity, None
+
+    if(time.time_ns() - mtime < racyDirWindowNs):
+        mtime = None
+
+    return identity, {'mtime': mtime, 'files': fileNames, 'dirs': subDirNames}
+
+
+def walkFontPaths(fontDirs, visitedDirs=None):
+    """Yields paths to files below the given directories, listing subdirectories concurrently
+
+    Directory listings are kept in dirRecord; every directory walked is
+    added to visitedDirs if given. A directory which is its own ancestor,
+    as reached through a symlink loop, is not descended into again.
+
+    The scan policy is applied while walking: excluded directories and
+    those beyond maxScanDepth are not listed at all, and files it rules out
+    are not yielded."""
+
+    global dirRecord
+
+    if(dirRecord is None):
+        # An interrupted walk got further than the last complete one
+        dirRecord = readCheckpoint().get('dirs') or readDirRecord()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=walkWorkers)
+
+    def submit(dirPath, ancestors, depth):
+        future = executor.submit(scanDir, dirPath, dirRecord.get(dirPath))
+        pending[future] = (dirPath, ancestors, depth)
+
+    try:
+        pending = {}
+        for fontDir in fontDirs:
+            if(not isExcludedDir(fontDir)):
+                submit(fontDir, frozenset(), getDirDepth(fontDir))
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                dirPath, ancestors, depth = pending.pop(future)
+                identity, listing = future.result()
+
+                if(identity in ancestors):
+                    print(f"Not following symlink loop at '{dirPath}'")
+                    continue
+
+                if(listing is None):
+                    dirRecord.pop(dirPath, None)
+                    continue
+
+                dirRecord[dirPath] = listing
+                if(visitedDirs is not None):
+                    visitedDirs.add(dirPath)
+
+                ancestors = ancestors | {identity}
+                if(maxScanDepth is None or depth < maxScanDepth):
+                    for subDirName in listing['dirs']:
+                        subDirPath = os.path.join(dirPath, subDirName)
+                        if(not isExcludedDir(subDirPath)):
+                            submit(subDirPath, ancestors, depth + 1)
+
+                for fileName in listing['files']:
+                    filePath = os.path.join(dirPath, fileName)
+                    if(isScannedFile(filePath)):
+                        yield filePath
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def getFontconfigFonts(fontDirs):
+    """Returns {(fontPath, faceIndex): family} for fonts fontconfig knows below fontDirs
+
+    Returns None if fontconfig is not installed or its caches are older
+    than any directory holding fonts."""
+
+    cacheMtimes = []
+    for cacheDir in fontconfigCacheDirs:
+        try:
+            with os.scandir(os.path.expanduser(cacheDir)) as entries:
+                cacheMtimes.extend(entry.stat().st_mtime_ns for entry in entries
+                                   if '.cache-' in entry.name)
+        except OSError:
+            pass
+
+    if(not cacheMtimes):
+        return None
+
+    try:
+        output = subprocess.run(
+            ['fc-list', '--format', '%{file}\t%{index}\t%{family[0]}\n'],
+            capture_output=True, check=True, timeout=60).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    prefixes = tuple(os.path.join(fontDir, '') for fontDir in fontDirs)
+
+    fonts = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split('\t')
+        if(len(fields) != 3 or not fields[0].startswith(prefixes)):
+            continue
+
+        # The upper bits of the index number variable font instances
+        fontPath, index, family = fields
+        fonts[(fontPath, int(index or 0) & 0xFFFF)] = family
+
+    # fontconfig only rescans directories whose mtime moved past its cache
+    newestCache = max(cacheMtimes)
+    for dirPath in {os.path.dirname(fontPath) for fontPath, faceIndex in fonts}:
+        try:
+            if(os.stat(dirPath).st_mtime_ns > newestCache):
+                return None
+        except OSError:
+            return None
+
+    for fontDir in getIndexedDirs(fontDirs, fonts):
+        try:
+            if(os.stat(fontDir).st_mtime_ns > newestCache):
+                return None
+        except OSError:
+            return None
+
+    return fonts
+
+
+def getIndexedDirs(fontDirs, fonts):
+    """Returns those of fontDirs in which fontconfig listed any of the given fonts"""
+
+    fontPaths = {fontPath for fontPath, faceIndex in fonts}
+
+    return [fontDir for fontDir in fontDirs
+            if any(fontPath.startswith(os.path.join(fontDir, '')) for fontPath in fontPaths)]
+
+
+def fillFromFontconfig(fontPath, fontMeta):
+    """Fills in families missing from a font's name table with those fontconfig reported"""
+
+    for faceMeta in fontMeta.get('faces', [fontMeta]):
+        family = fontconfigFamilies.get((fontPath, faceMeta.get('face', 0)))
+        if(family and not faceMeta.get('font_family')):
+            faceMeta['font_family'] = family
+
+
+def getFontPaths():
+    """Returns a list of paths to files, possibly fonts, existing in system folders"""
+
+    global fontconfigBootstrapped
+
+    fontDirs = getFontDirs()
+    walkedAll = True
+
+    if(bootstrapFromFontconfig and not fontconfigBootstrapped):
+        fontconfigBootstrapped = True
+
+        fonts = getFontconfigFonts(fontDirs)
+        if(fonts is not None):
+            # Later scans walk the directories as usual
+            fontconfigFamilies.update(fonts)
+
+            indexedDirs = getIndexedDirs(fontDirs, fonts)
+            prefixes = tuple(os.path.join(fontDir, '') for fontDir in indexedDirs)
+
+            # fontconfig knows nothing of zip bundles and leaves out fonts it
+            # rejects, so recorded files it did not list are carried over
+            fontPaths = dict.fromkeys(fontPath for fontPath, faceIndex in fonts)
+            for fontPath in unpackRecords(readMetaRecord()):
+                if(fontPath.startswith(prefixes) and os.path.isfile(fontPath)):
+                    fontPaths.setdefault(fontPath)
+
+            yield from (fontPath for fontPath in fontPaths if isWithinPolicy(fontPath))
+
+            # Directories fontconfig does not index are walked all the same
+            fontDirs = [fontDir for fontDir in fontDirs if fontDir not in indexedDirs]
+            walkedAll = False
+
+    visitedDirs = set()
+    for filePath in walkFontPaths(fontDirs, visitedDirs):
+        yield filePath
+
+        if(isCheckpointDue()):
+            writeCheckpoint()
+
+    # Only once a walk of everything completed is anything not visited gone
+    if(walkedAll):
+        for staleDir in dirRecord.keys() - visitedDirs:
+            del dirRecord[staleDir]
+
+    updateDirRecord(dirRecord)
+
+
+def isCheckpointDue():
+    return (lastCheckpoint is not None and
+            time.monotonic() - lastCheckpoint >= checkpointInterval)
+
+
+def writeCheckpoint():
+    """Saves the directory listings and metadata gathered so far by a running scan"""
+
+    global lastCheckpoint
+
+    checkpoint = {
+        'dirs': dirRecord,
+        'meta': {fontPath: [list(signature), fontMeta]
+                 for fontPath, (signature, fontMeta) in (metaCache or {}).items()
+                 if signature is not None},
+    }
+
+    # Written aside and moved into place so a crash never leaves half a file
+    with open(checkpointPath + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpointPath + '.tmp', checkpointPath)
+
+    lastCheckpoint = time.monotonic()
+
+
+def readCheckpoint():
+    try:
+
+        with open(checkpointPath, 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+
+def removeCheckpoint():
+    try:
+        os.remove(checkpointPath)
+    except OSError:
+        pass
+
+
+def getStatSignature(st):
+    """Returns a tuple identifying a file's on-disk state from its stat result"""
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def hasDrifted(filePath, signature):
+    """Returns True if the file no longer has the stat signature it was read with"""
+
+    try:
+        return getStatSignature(os.stat(filePath)) != signature
+    except OSError:
+        return True
+
+
+class UnsupportedFont(Exception):
+    """Raised by the fast name table reader for fonts only FontMeta can handle"""
+
+
+sfntVersions = {b'\x00\x01\x00\x00', b'OTTO', b'true'}
+sfntHeader = struct.Struct('>4sHHHH')
+sfntTableRecord = struct.Struct('>4sIII')
+nameHeader = struct.Struct('>HHH')
+nameRecord = struct.Struct('>HHHHHH')
+ttcHeader = struct.Struct('>4sHHI')
+woffHeader = struct.Struct('>4s4sIHHIHHIIIII')
+woffTableRecord = struct.Struct('>4sIIII')
+fvarHeader = struct.Struct('>HHHHHHHH')
+fvarInstanceRecord = struct.Struct('>HH')
+
+
+def decodeName(platformId, encodingId, languageId, string):
+    """Decodes a name table string the same way fontTools does for FontMeta"""
+
+    encoding = getEncoding(platformId, encodingId, languageId)
+    if(encoding is None):
+        raise UnsupportedFont(f"unknown encoding {platformId}/{encodingId}")
+    if(encoding == 'utf_16_be' and len(string) % 2):
+        # fontTools applies recovery heuristics to these
+        raise UnsupportedFont("odd length UTF-16 name")
+
+    name = string.decode(encoding)
+
+    # Undo double encoding of ASCII text as UTF-16, as fontTools does
+    if(all(ord(c) == 0 if i % 2 == 0 else isPrintableAscii(ord(c))
+           for i, c in enumerate(name))):
+        name = name[1::2]
+
+    return name
+
+
+def isPrintableAscii(c):
+    return 0x20 <= c <= 0x7E or c in (0x09, 0x0A, 0x0D)
+
+
+def readNameTable(data, tableOffset, tableLength):
+    """Returns the reported fields from a 'name' table located in data"""
+
+    names = readNames(data, tableOffset, tableLength, metaNameIds.keys())
+    return {metaNameIds[nameId]: name for nameId, name in names.items()}
+
+
+def readNames(data, tableOffset, tableLength, nameIds):
+    """Returns {nameId: name} for the given IDs from a 'name' table located in data"""
+
+    tableEnd = tableOffset + tableLength
+    if(tableEnd > len(data)):
+        raise UnsupportedFont("truncated name table")
+
+    nameFormat, count, stringOffset = nameHeader.unpack_from(data, tableOffset)
+    stringStart = tableOffset + stringOffset
+
+    names = {}
+    for i in range(count):
+        recordOffset = tableOffset + nameHeader.size + i * nameRecord.size
+        if(recordOffset + nameRecord.size > tableEnd):
+            break
+
+        platformId, encodingId, languageId, nameId, length, offset = \
+            nameRecord.unpack_from(data, recordOffset)
+
+        if(platformId > 4):
+            raise UnsupportedFont(f"unknown platform {platformId}")
+
+        if(nameId not in nameIds):
+            continue
+
+        start = stringStart + offset
+        if(start + length > tableEnd):
+            continue
+
+        # Later records win, matching FontMeta.get_data()
+        names[nameId] = decodeName(
+            platformId, encodingId, languageId, data[start:start + length])
+
+    return names
+
+
+def readInstanceNameIds(fvarTable):
+    """Returns the subfamily name IDs of the named instances in a variable font's 'fvar' table"""
+
+    (majorVersion, minorVersion, axesArrayOffset, reserved, axisCount, axisSize,
+     instanceCount, instanceSize) = fvarHeader.unpack_from(fvarTable)
+
+    instancesOffset = axesArrayOffset + axisCount * axisSize
+    return [fvarInstanceRecord.unpack_from(fvarTable, instancesOffset + i * instanceSize)[0]
+            for i in range(instanceCount)]
+
+
+def readFaceMeta(data, nameLocation, fvarTable=None):
+    """Returns the reported fields of a face from its 'name' table located in
+    data, plus the names of its named instances under 'instances' if its
+    'fvar' table is given
+
+    fvar and name are each read once for all instances."""
+
+    if(fvarTable is None):
+        return readNameTable(data, *nameLocation)
+
+    instanceNameIds = readInstanceNameIds(fvarTable)
+    names = readNames(data, *nameLocation, metaNameIds.keys() | set(instanceNameIds))
+
+    fontMeta = {metaNameIds[nameId]: name for nameId, name in names.items()
+                if nameId in metaNameIds}
+
+    # Instances without a name cannot be told apart, and duplicates would clash
+    instances = list(dict.fromkeys(names[nameId] for nameId in instanceNameIds
+                                   if nameId in names))
+    if(instances):
+        fontMeta['instances'] = instances
+
+    return fontMeta
+
+
+def findTable(data, offset, wantedTag):
+    """Returns (tableOffset, tableLength) of a table of the sfnt font starting at offset in data"""
+
+    version, numTables, searchRange, entrySelector, rangeShift = \
+        sfntHeader.unpack_from(data, offset)
+
+    if(version not in sfntVersions):
+        raise UnsupportedFont(f"unknown sfnt version {version!r}")
+
+    for i in range(numTables):
+        tag, checksum, tableOffset, tableLength = sfntTableRecord.unpack_from(
+            data, offset + sfntHeader.size + i * sfntTableRecord.size)
+
+        if(tag == wantedTag):
+            return tableOffset, tableLength
+
+    raise UnsupportedFont(f"no {wantedTag.decode()} table")
+
+
+def findOptionalTable(data, offset, wantedTag):
+    """Returns (tableOffset, tableLength) like findTable(), or None if the font has no such table"""
+
+    try:
+        return findTable(data, offset, wantedTag)
+    except UnsupportedFont:
+        return None
+
+
+def getTable(data, location):
+    """Returns the bytes of a table at (tableOffset, tableLength) in data, or None for no table"""
+
+    if(location is None):
+        return None
+
+    tableOffset, tableLength = location
+    if(tableOffset + tableLength > len(data)):
+        raise UnsupportedFont("truncated table")
+
+    return data[tableOffset:tableOffset + tableLength]
+
+
+def readSfntMeta(data, offset=0):
+    """Returns the reported fields of the sfnt font starting at offset in data"""
+
+    return readFaceMeta(data, findTable(data, offset, b'name'),
+                        getTable(data, findOptionalTable(data, offset, b'fvar')))
+
+
+def getCollectionOffsets(data):
+    """Returns the offsets of every face's table directory in a TrueType/OpenType collection"""
+
+    tag, majorVersion, minorVersion, numFonts = ttcHeader.unpack_from(data)
+    return struct.unpack_from(f'>{numFonts}I', data, ttcHeader.size)
+
+
+def readCollectionMeta(data):
+    """Returns {'faces': [faceMeta]} for a collection, each face tagged with its index
+
+    Faces commonly share one name table; it is only decoded once."""
+
+    nameTables = {}
+    faces = []
+
+    for faceIndex, offset in enumerate(getCollectionOffsets(data)):
+        tableLocations = (findTable(data, offset, b'name'),
+                          findOptionalTable(data, offset, b'fvar'))
+        if(tableLocations not in nameTables):
+            nameLocation, fvarLocation = tableLocations
+            nameTables[tableLocations] = readFaceMeta(
+                data, nameLocation, getTable(data, fvarLocation))
+
+        faces.append(dict(nameTables[tableLocations], face=faceIndex))
+
+    return {'faces': faces}
+
+
+def findWoffTable(data, wantedTag):
+    """Returns (offset, compLength, origLength) of a table of a WOFF 1.0 font"""
+
+    numTables = woffHeader.unpack_from(data)[3]
+
+    for i in range(numTables):
+        tag, offset, compLength, origLength, origChecksum = woffTableRecord.unpack_from(
+            data, woffHeader.size + i * woffTableRecord.size)
+
+        if(tag == wantedTag):
+            return offset, compLength, origLength
+
+    raise UnsupportedFont(f"no {wantedTag.decode()} table")
+
+
+def inflateWoffTable(table, origLength):
+    """Returns the uncompressed bytes of a WOFF table"""
+
+    if(len(table) < origLength):
+        # Bounded by the declared size, whatever the stream claims
+        table = zlib.decompressobj().decompress(table, origLength)
+
+    if(len(table) != origLength):
+        raise UnsupportedFont("table size mismatch")
+
+    return table
+
+
+def findOptionalWoffTable(data, wantedTag):
+    """Returns (offset, compLength, origLength) like findWoffTable(), or None if the font has no such table"""
+
+    try:
+        return findWoffTable(data, wantedTag)
+    except UnsupportedFont:
+        return None
+
+
+def readWoffMeta(data):
+    """Returns the reported fields of a WOFF 1.0 font, inflating only its name
+    and fvar tables"""
+
+    tables = []
+    for location in (findWoffTable(data, b'name'), findOptionalWoffTable(data, b'fvar')):
+        if(location is None):
+            tables.append(None)
+            continue
+
+        offset, compLength, origLength = location
+        if(offset + compLength > len(data)):
+            raise UnsupportedFont("truncated table")
+
+        tables.append(inflateWoffTable(data[offset:offset + compLength], origLength))
+
+    nameTable, fvarTable = tables
+    return readFaceMeta(nameTable, (0, len(nameTable)), fvarTable)
+
+
+def readAt(f, offset, length):
+    """Returns exactly length bytes at offset of a file object"""
+
+    f.seek(offset)
+    data = f.read(length)
+
+    if(len(data) != length):
+        raise UnsupportedFont("truncated font")
+
+    return data
+
+
+def readSfntDirectory(f, offset):
+    """Returns the header and table directory of the sfnt font at offset of a file object"""
+
+    header = readAt(f, offset, sfntHeader.size)
+    numTables = sfntHeader.unpack_from(header)[1]
+
+    return header + readAt(f, offset + sfntHeader.size, numTables * sfntTableRecord.size)
+
+
+def readStreamMeta(f):
+    """Returns the metadata of the font in a file object, reading nothing
+    but its directories and name tables
+
+    Reads go forward through the file as far as fonts allow, since seeking
+    back in a compressed zip member inflates it again from the start."""
+
+    magic = readAt(f, 0, 4)
+
+    if(magic == b'wOFF'):
+        header = readAt(f, 0, woffHeader.size)
+        numTables = woffHeader.unpack_from(header)[3]
+        directory = header + readAt(f, woffHeader.size, numTables * woffTableRecord.size)
+
+        woffLocations = [findWoffTable(directory, b'name'),
+                         findOptionalWoffTable(directory, b'fvar')]
+
+        tables = {}
+        for location in sorted(filter(None, woffLocations)):
+            offset, compLength, origLength = location
+            tables[location] = inflateWoffTable(readAt(f, offset, compLength), origLength)
+
+        nameTable = tables[woffLocations[0]]
+        return readFaceMeta(nameTable, (0, len(nameTable)), tables.get(woffLocations[1]))
+
+    if(magic == b'ttcf'):
+        header = readAt(f, 0, ttcHeader.size)
+        numFonts = ttcHeader.unpack_from(header)[3]
+        faceOffsets = getCollectionOffsets(header + readAt(f, ttcHeader.size, numFonts * 4))
+    else:
+        faceOffsets = [0]
+
+    faceLocations = []
+    for offset in faceOffsets:
+        directory = readSfntDirectory(f, offset)
+        faceLocations.append((findTable(directory, 0, b'name'),
+                              findOptionalTable(directory, 0, b'fvar')))
+
+    tables = {}
+    for location in sorted({location for locations in faceLocations
+                            for location in locations if location is not None}):
+        tables[location] = readAt(f, *location)
+
+    faces = []
+    for nameLocation, fvarLocation in faceLocations:
+        nameTable = tables[nameLocation]
+        faces.append(readFaceMeta(nameTable, (0, len(nameTable)), tables.get(fvarLocation)))
+
+    if(magic != b'ttcf'):
+        return faces[0]
+
+    return {'faces': [dict(faceMeta, face=faceIndex) for faceIndex, faceMeta in enumerate(faces)]}
+
+
+def readZipMeta(f):
+    """Returns {'members': [memberMeta]} for the fonts in a zip bundle
+
+    Each member is tagged with its name within the bundle, suffixed by
+    '#index' for the faces of collections. Only the central directory and
+    the directories and name tables of font members are read; members
+    which are not fonts are only inflated as far as their magic bytes.
+
+    Font members which cannot be read are left out and listed as
+    {memberName: reason} under 'failures'."""
+
+    members = []
+    failures = {}
+
+    with zipfile.ZipFile(f) as bundle:
+        for info in bundle.infolist():
+            # Encrypted members cannot be read without a password
+            if(info.is_dir() or info.flag_bits & 0x1):
+                continue
+
+            if(maxFontSize is not None and info.file_size > maxFontSize):
+                continue
+
+            # One bad member, such as one compressed with a method zipfile
+            # does not support, must not cost the rest of the bundle
+            try:
+                with bundle.open(info) as member:
+                    if(fontMagic.get(member.read(4)) in (None, 'zip')):
+                        continue
+
+                    memberMeta = readStreamMeta(member)
+            except (UnsupportedFont, struct.error, ValueError, zlib.error,
+                    NotImplementedError, zipfile.BadZipFile, EOFError) as e:
+                failures[info.filename] = f"{type(e).__name__}: {e}"
+                continue
+
+            for faceMeta in memberMeta.get('faces', [memberMeta]):
+                memberName = info.filename
+                if('face' in faceMeta):
+                    memberName += f"#{faceMeta.pop('face')}"
+
+                members.append(dict(faceMeta, member=memberName))
+
+    if(failures):
+        return {'members': members, 'failures': failures}
+
+    return {'members': members}
+
+
+def readFontMeta(fontPath):
+    """Reads the reported fields straight from the font's mmapped name table"""
+
+    with open(fontPath, 'rb') as f:
+        if(f.read(4) == b'PK\x03\x04'):
+            # Members are inflated as they are read rather than mapped
+            return readZipMeta(f)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if(data[:4] == b'ttcf'):
+                return readCollectionMeta(data)
+            if(data[:4] == b'wOFF'):
+                return readWoffMeta(data)
+            return readSfntMeta(data)
+
+
+def extractMeta(fontPath):
+    """Returns the metadata of a single font file
+
+    Collections yield {'faces': [faceMeta]} instead, see readCollectionMeta(),
+    and zip bundles {'members': [memberMeta]}, see readZipMeta()."""
+
+    try:
+        return readFontMeta(fontPath)
+    except (UnsupportedFont, struct.error, ValueError, zlib.error):
+        # ValueError also covers empty files, which cannot be mmapped, and
+        # names that do not decode
+        fontMeta = FontMeta(fontPath).get_data()
+        return {key: fontMeta[key] for key in validMetaKeys if key in fontMeta}
+    finally:
+        if(dropCacheAfterRead):
+            try:
+                with open(fontPath, 'rb') as f:
+                    dropPageCache(f.fileno())
+            except OSError:
+                pass
+
+
+def extractChunk(fontPaths):
+    """Parses a batch of fonts, returning a list of (fontPath, fontMeta, error)"""
+
+    res = []
+    for fontPath in fontPaths:
+        try:
+            res.append((fontPath, extractMeta(fontPath), None))
+        except Exception as e:
+            res.append((fontPath, None, f"{type(e).__name__}: {e}"))
+
+    return res
+
+
+def getExtractPool():
+    """Returns the process pool used for parsing, creating it on first use"""
+
+    global extractPool
+
+    if(extractPool is None):
+        extractPool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=extractWorkers or os.cpu_count())
+
+    return extractPool
+
+
+def sandboxWorker(conn, memoryLimit):
+    """Runs in a sandbox process, parsing the font paths it is sent one at a time"""
+
+    if(resource is not None):
+        resource.setrlimit(resource.RLIMIT_AS, (memoryLimit, memoryLimit))
+
+    while True:
+        try:
+            fontPath = conn.recv()
+        except EOFError:
+            return
+
+        conn.send(extractChunk([fontPath])[0])
+
+
+class SandboxPool:
+    """Worker processes parsing one font at a time under memory and time limits
+
+    A worker which overruns extractTimeout, dies, or runs out of memory is
+    killed and replaced, and its font is reported as failed so it ends up
+    quarantined in the failure record."""
+
+    def __init__(self, size):
+        self.workers = [self.startWorker() for i in range(size)]
+
+    def startWorker(self):
+        parentConn, childConn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=sandboxWorker, args=(childConn, extractMemoryLimit), daemon=True)
+        process.start()
+        childConn.close()
+
+        return process, parentConn
+
+    def replaceWorker(self, worker):
+        process, conn = worker
+        process.kill()
+        process.join()
+        conn.close()
+
+        newWorker = self.startWorker()
+        self.workers[self.workers.index(worker)] = newWorker
+
+        return newWorker
+
+    def extract(self, fontPaths, throttle=None):
+        """Yields (fontPath, fontMeta, error) for every path, calling throttle(fontPath) before each"""
+
+        queue = list(reversed(fontPaths))
+        idle = list(self.workers)
+        busy = {}
+
+        while queue or busy:
+
+            while queue and idle:
+                worker = idle.pop()
+                fontPath = queue.pop()
+
+                if(throttle is not None):
+                    throttle(fontPath)
+
+                try:
+                    worker[1].send(fontPath)
+                except OSError:
+                    # Died while idle; try again with a fresh worker
+                    idle.append(self.replaceWorker(worker))
+                    queue.append(fontPath)
+                    continue
+
+                busy[worker[1]] = (worker, fontPath, time.monotonic() + extractTimeout)
+
+            nextDeadline = min(deadline for worker, fontPath, deadline in busy.values())
+            ready = multiprocessing.connection.wait(
+                list(busy), max(nextDeadline - time.monotonic(), 0))
+
+            for conn in ready:
+                worker, fontPath, deadline = busy.pop(conn)
+
+                try:
+                    result = conn.recv()
+                except (EOFError, OSError):
+                    worker = self.replaceWorker(worker)
+                    result = (fontPath, None, "parser process died")
+                else:
+                    if(result[2] is not None and result[2].startswith('MemoryError')):
+                        worker = self.replaceWorker(worker)
+
+                idle.append(worker)
+                yield result
+
+            now = time.monotonic()
+            for conn, (worker, fontPath, deadline) in list(busy.items()):
+                if(deadline <= now):
+                    del busy[conn]
+                    idle.append(self.replaceWorker(worker))
+                    yield (fontPath, None, f"parsing took longer than {extractTimeout}s")
+
+
+def getSandboxPool():
+    """Returns the sandboxed worker pool, creating it on first use"""
+
+    global sandboxPool
+
+    if(sandboxPool is None):
+        sandboxPool = SandboxPool(extractWorkers or os.cpu_count())
+
+    return sandboxPool
+
+
+def isRotational(dev):
+    """Returns True if Linux reports the block device behind st_dev as a spinning disk"""
+
+    if(not hasattr(os, 'major')):
+        return False
+
+    sysPath = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+
+    # Partitions keep their queue settings on the parent disk
+    for queuePath in (os.path.join(sysPath, 'queue', 'rotational'),
+                      os.path.join(sysPath, '..', 'queue', 'rotational')):
+        try:
+            with open(queuePath, 'r') as f:
+                return f.read().strip() == '1'
+        except OSError:
+            pass
+
+    # Network and virtual filesystems have no block device
+    return False
+
+
+def getDeviceConcurrency(dev):
+    """Returns how many files may be read at once from a device"""
+
+    if(dev not in deviceLimits):
+        limit = None
+
+        for path, configured in deviceConcurrency.items():
+            try:
+                if(os.stat(path).st_dev == dev):
+                    limit = configured
+            except OSError:
+                pass
+
+        if(limit is None):
+            limit = rotationalConcurrency if isRotational(dev) else (extractWorkers or os.cpu_count())
+
+        deviceLimits[dev] = limit
+
+    return deviceLimits[dev]
+
+
+def groupByDevice(fontPaths, signatures):
+    """Returns {st_dev: [fontPath]} with each device's paths in inode order"""
+
+    byDevice = {}
+    for fontPath in sorted(fontPaths, key=lambda fontPath: signatures[fontPath][:2]):
+        byDevice.setdefault(signatures[fontPath][0], []).append(fontPath)
+
+    return byDevice
+
+
+def runPerDevice(executor, func, itemsByDevice, throttle=None):
+    """Runs func over each device's work items in order, keeping at most
+    getDeviceConcurrency(dev) of them in flight per device
+
+    throttle(item) is called before each item is submitted. Yields
+    (item, future) as items complete."""
+
+    queues = {dev: list(reversed(items)) for dev, items in itemsByDevice.items()}
+    inFlight = {dev: 0 for dev in queues}
+    running = {}
+
+    def fill():
+        for dev, queue in queues.items():
+            while queue and inFlight[dev] < getDeviceConcurrency(dev):
+                item = queue.pop()
+                if(throttle is not None):
+                    throttle(item)
+                inFlight[dev] += 1
+                running[executor.submit(func, item)] = (dev, item)
+
+    fill()
+    while running:
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for future in done:
+            dev, item = running.pop(future)
+            inFlight[dev] -= 1
+            yield item, future
+
+        fill()
+
+
+def extractAll(fontPaths, signatures):
+    """Yields (fontPath, fontMeta, error) for every path, parsing in worker processes
+
+    Paths are grouped by device and read in inode order so spinning disks
+    are not made to seek back and forth."""
+
+    global extractPool
+
+    if(not fontPaths):
+        return
+
+    byDevice = groupByDevice(fontPaths, signatures)
+
+    def throttle(chunk):
+        throttleRead(len(chunk), sum(signatures[fontPath][2] for fontPath in chunk))
+
+    if(isolateExtraction):
+        yield from getSandboxPool().extract(
+            [fontPath for devicePaths in byDevice.values() for fontPath in devicePaths],
+            lambda fontPath: throttle([fontPath]))
+        return
+
+    if(len(fontPaths) <= extractChunkSize):
+        # Not worth the round trip to a worker
+        for devicePaths in byDevice.values():
+            for fontPath in devicePaths:
+                throttle([fontPath])
+                yield from extractChunk([fontPath])
+        return
+
+    chunksByDevice = {
+        dev: [tuple(devicePaths[i:i + extractChunkSize])
+              for i in range(0, len(devicePaths), extractChunkSize)]
+        for dev, devicePaths in byDevice.items()}
+
+    finished = set()
+
+    try:
+        for chunk, future in runPerDevice(getExtractPool(), extractChunk,
+                                          chunksByDevice, throttle):
+            try:
+                results = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died outright; start a fresh pool next time and
+                # parse what it was holding here instead
+                extractPool = None
+                results = extractChunk(chunk)
+
+            finished.update(chunk)
+            yield from results
+
+    except concurrent.futures.process.BrokenProcessPool:
+        # The pool broke while work was still being handed out
+        extractPool = None
+        yield from extractChunk([fontPath for fontPath in fontPaths if fontPath not in finished])
+
+
+def readRange(f, data, offset, length):
+    """Returns length bytes at offset, from data if it already holds them, else from f"""
+
+    if(offset + length <= len(data)):
+        return data[offset:offset + length]
+
+    f.seek(offset)
+    return f.read(length)
+
+
+def readFingerprint(f):
+    """Returns a digest of the table directories and head.checksumAdjustment of an open font, or None if there is none"""
+
+    data = f.read(fingerprintReadSize)
+
+    if(data[:4] == b'wOFF'):
+        # The WOFF directory records each table's uncompressed checksum
+        numTables = woffHeader.unpack_from(data)[3]
+        return hashlib.blake2b(
+            readRange(f, data, 0, woffHeader.size + numTables * woffTableRecord.size),
+            digest_size=16).hexdigest()
+
+    if(data[:4] == b'ttcf'):
+        tag, majorVersion, minorVersion, numFonts = ttcHeader.unpack_from(data)
+        header = readRange(f, data, 0, ttcHeader.size + numFonts * 4)
+        faceOffsets = getCollectionOffsets(header)
+    elif(data[:4] in sfntVersions):
+        header = b''
+        faceOffsets = [0]
+    else:
+        return None
+
+    digest = hashlib.blake2b(header, digest_size=16)
+
+    for offset in faceOffsets:
+        version, numTables, searchRange, entrySelector, rangeShift = \
+            sfntHeader.unpack_from(readRange(f, data, offset, sfntHeader.size))
+
+        directory = readRange(f, data, offset + sfntHeader.size,
+                              numTables * sfntTableRecord.size)
+        digest.update(directory)
+
+        for i in range(numTables):
+            tag, checksum, tableOffset, tableLength = \
+                sfntTableRecord.unpack_from(directory, i * sfntTableRecord.size)
+
+            if(tag == b'head'):
+                # checksumAdjustment covers the whole file
+                digest.update(readRange(f, data, tableOffset + 8, 4))
+                break
 
-import openapi_client
-from openapi_client.api import default_api
-from openapi_client.model.font import Font
+    return digest.hexdigest()
 
-metaRecordPath = 'meta_record.json'
 
+def getFingerprint(fontPath):
+    """Returns the fingerprint of a font file, or None if it has none or cannot be read"""
 
-def getFontDirs():
-    """Returns a list of directories in which fonts may exist"""
+    throttleRead(1, fingerprintReadSize)
 
-    res = []
-    if(sys.platform.startswith('linux')):
-        res = ['/usr/share/fonts', '~/fonts']
-    elif(sys.platform.startswith('win32')):
-        res = ['C:\\Windows\\Fonts']
-    elif(sys.platform.startswith('darwin')):
-        res = ['~/Library/Fonts']
+    try:
+        with open(fontPath, 'rb') as f:
+            try:
+                return readFingerprint(f)
+            finally:
+                dropPageCache(f.fileno())
 
-    return list(filter(os.path.isdir, res))
+    except (OSError, struct.error):
+        return None
 
 
-def getFontPaths():
-    """Returns a list of paths to fonts existing in system folders"""
-
-    for fontDir in getFontDirs():
-        for dirPath, subDirNames, fileNames in os.walk(fontDir):
-            for fileName in fileNames:
-                filePath = os.path.join(dirPath, fileName)
-                if(os.path.isfile(filePath)):
-                    root, ext = os.path.splitext(fileName)
-                    if(ext in ['.otf', '.ttf']):
-                        yield filePath
+def getDigest(fontPath):
+    """Returns a blake2b digest of the whole file, or None if it cannot be read"""
 
+    digest = hashlib.blake2b(digest_size=16)
 
-def getCurrentMeta():
-    """Returns a dict containing font metadata in a {fontPath: fontMeta} format"""
+    try:
+        with open(fontPath, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                return digest.hexdigest()
+
+            with data:
+                for offset in range(0, len(data), digestBlockSize):
+                    digest.update(data[offset:offset + digestBlockSize])
+
+            dropPageCache(f.fileno())
+
+    except OSError:
+        return None
+
+    return digest.hexdigest()
+
+
+def getDigests(fontPaths, signatures):
+    """Returns {fontPath: digest}, hashing files concurrently within each device's limit"""
+
+    digests = {}
+
+    # hashlib releases the GIL on large buffers, so threads are enough here
+    with concurrent.futures.ThreadPoolExecutor(max_workers=walkWorkers) as executor:
+        byDevice = groupByDevice(fontPaths, signatures)
+        throttle = lambda fontPath: throttleRead(1, signatures[fontPath][2])
+        for fontPath, future in runPerDevice(executor, getDigest, byDevice, throttle):
+            digests[fontPath] = future.result()
+
+    return digests
+
+
+def isBackedOff(fontPath, signature):
+    """Returns True if the font failed to parse before and should not be retried yet"""
+
+    failure = failureRecord.get(fontPath)
+    if(failure is None):
+        return False
+
+    # Parsing the same bytes again would fail the same way
+    if(tuple(failure['signature']) == signature):
+        return True
+
+    return time.time() < failure['retryAt']
+
+
+def recordFailure(fontPath, signature, reason):
+    """Remembers that a font failed to parse and when it may be retried"""
+
+    failure = failureRecord.get(fontPath)
+    failures = 1 if failure is None else failure['failures'] + 1
+    delay = min(failureRetryBaseSeconds * 2 ** (failures - 1), failureRetryMaxSeconds)
+
+    failureRecord[fontPath] = {
+        'signature': list(signature),
+        'reason': reason,
+        'failures': failures,
+        'retryAt': time.time() + delay,
+    }
+
+    print(f"Unable to read '{fontPath}': {reason}")
+
+
+def recordMemberFailures(fontPath, signature, fontMeta):
+    """Brings the failure record of a zip bundle's members in line with its
+    latest read, returning True if anything changed
+
+    Members are recorded by their composite path, with 'file' naming the bundle."""
+
+    stalePaths = [failedPath for failedPath, failure in failureRecord.items()
+                  if failure.get('file') == fontPath]
+    for stalePath in stalePaths:
+        del failureRecord[stalePath]
+
+    failures = fontMeta.get('failures', {})
+    for memberName, reason in failures.items():
+        memberPath = f"{fontPath}!{memberName}"
+        recordFailure(memberPath, signature, reason)
+        failureRecord[memberPath]['file'] = fontPath
+
+    return bool(stalePaths or failures)
+
+
+def packRecords(fontPath, fontMeta):
+    """Returns the {recordPath: recordMeta} entries reported for one font file
+
+    Every face of a collection becomes its own record, named by the file
+    path with a '#index' suffix and carrying the file's fingerprint and
+    digest. Fonts in a zip bundle likewise become records named
+    'bundlePath!memberName', and every named instance of a variable font
+    one named '...@instanceName'."""
+
+    fileKeys = {key: fontMeta[key] for key in ('fingerprint', 'digest') if key in fontMeta}
+
+    if('members' in fontMeta):
+        parts = {f"{fontPath}!{memberMeta['member']}": dict(memberMeta, **fileKeys)
+                 for memberMeta in fontMeta['members']}
+    elif('faces' in fontMeta):
+        parts = {f"{fontPath}#{faceMeta['face']}": dict(faceMeta, **fileKeys)
+                 for faceMeta in fontMeta['faces']}
+    else:
+        parts = {fontPath: fontMeta}
+
+    records = {}
+    for partPath, partMeta in parts.items():
+        if('instances' not in partMeta):
+            records[partPath] = partMeta
+            continue
+
+        instanceMeta = {key: value for key, value in partMeta.items() if key != 'instances'}
+        for instance in partMeta['instances']:
+            records[f"{partPath}@{instance}"] = dict(instanceMeta, instance=instance)
+
+    return records
+
+
+def getRecordFile(recordPath, recordMeta):
+    """Returns the path of the file a record was read from"""
+
+    if('instance' in recordMeta):
+        recordPath = recordPath[:-len(recordMeta['instance']) - 1]
+
+    if('member' in recordMeta):
+        return recordPath[:-len(recordMeta['member']) - 1]
+
+    if('face' in recordMeta):
+        return recordPath.rsplit('#', 1)[0]
+
+    return recordPath
+
+
+def unpackRecords(records):
+    """Turns {recordPath: recordMeta} back into {fontPath: fontMeta}, reassembling
+    collections and zip bundles"""
+
+    # Named instances share everything but their name
+    parts = {}
+    for recordPath, recordMeta in records.items():
+        if('instance' not in recordMeta):
+            parts[recordPath] = recordMeta
+            continue
+
+        partPath = recordPath[:-len(recordMeta['instance']) - 1]
+        if(partPath not in parts):
+            parts[partPath] = {key: value for key, value in recordMeta.items() if key != 'instance'}
+            parts[partPath]['instances'] = []
+
+        parts[partPath]['instances'].append(recordMeta['instance'])
+
+    fontsMeta = {}
+
+    for recordPath, recordMeta in parts.items():
+        if('face' in recordMeta):
+            partsKey = 'faces'
+        elif('member' in recordMeta):
+            partsKey = 'members'
+        else:
+            fontsMeta[recordPath] = recordMeta
+            continue
 
+        fontPath = getRecordFile(recordPath, recordMeta)
+        fontMeta = fontsMeta.setdefault(fontPath, {partsKey: []})
+
+        partMeta = dict(recordMeta)
+        for key in ('fingerprint', 'digest'):
+            if(key in partMeta):
+                fontMeta[key] = partMeta.pop(key)
+
+        fontMeta[partsKey].append(partMeta)
+
+    for fontMeta in fontsMeta.values():
+        if('faces' in fontMeta):
+            fontMeta['faces'].sort(key=lambda faceMeta: faceMeta['face'])
+
+    return fontsMeta
+
+
+def isRecordOf(recordPath, recordMeta, fontPath):
+    """Returns True if a record is of the font file itself or one of its
+    faces, members or named instances"""
+
+    return getRecordFile(recordPath, recordMeta) == fontPath
+
+
+def loadMetaCache():
+    """Seeds metaCache and its indexes from the meta record and from the
+    checkpoint of an interrupted scan, once
+
+    Full scans call this before walking, so a checkpoint falling due during
+    the walk cannot overwrite the previous checkpoint before it was read."""
+
+    global metaCache
+
+    if(metaCache is not None):
+        return
+
+    metaCache = {fontPath: (None, fontMeta)
+                 for fontPath, fontMeta in unpackRecords(readMetaRecord()).items()}
+
+    # Pick up where an interrupted scan left off
+    for fontPath, (signature, fontMeta) in readCheckpoint().get('meta', {}).items():
+        metaCache[fontPath] = (tuple(signature), fontMeta)
+
+    for signature, fontMeta in metaCache.values():
+        if(signature is not None):
+            signatureIndex[signature] = fontMeta
+        if('digest' in fontMeta):
+            digestIndex[fontMeta['digest']] = fontMeta
+
+
+def getMeta(fontPaths):
+    """Returns {recordPath: fontMeta} for those of the given files that are fonts
+
+    Files are only parsed if both their stat signature and their
+    fingerprint changed since they were last read, and only once per
+    distinct content digest. Files which failed to parse are retried
+    with exponential backoff, and only after they change.
+
+    Every read is bracketed by a stat before and after it. Files which
+    changed meanwhile are read again up to snapshotRetries times and then
+    deferred: until they settle, what was known of them before is returned.
+
+    During full scans progress is checkpointed every checkpointInterval seconds."""
+
+    global failureRecord
+    global scanGeneration
+
+    scanGeneration += 1
+
+    if(failureRecord is None):
+        failureRecord = readFailureRecord()
+    failureCount = len(failureRecord)
+
+    loadMetaCache()
+
+    signatures = {}
+    fingerprints = {}
+    toDigest = []
+    aliases = {}
+    aliasedSignatures = {}
+    skippedSignatures = set()
+
+    for fontPath in fontPaths:
+        try:
+            signature = getStatSignature(os.stat(fontPath))
+        except OSError:
+            continue
+
+        if(maxFontSize is not None and signature[2] > maxFontSize):
+            continue
+
+        signatures[fontPath] = signature
+
+        cached = metaCache.get(fontPath)
+        if(cached is not None and cached[0] == signature):
+            continue
+
+        # Hardlinks and symlinks to one file share (st_dev, st_ino) and so
+        # the whole signature. Aliases are resolved before anything is
+        # opened, so every physical file is only opened through one name
+        if(signature in signatureIndex):
+            metaCache[fontPath] = (signature, signatureIndex[signature])
+            continue
+
+        if(signature in aliasedSignatures):
+            aliases[fontPath] = aliasedSignatures[signature]
+            continue
+
+        # Whatever the name, only files that look like fonts are parsed
+        if(signature in skippedSignatures or sniffFont(fontPath, signature) is None or
+                isBackedOff(fontPath, signature)):
+            skippedSignatures.add(signature)
+            del signatures[fontPath]
+            continue
+
+        aliasedSignatures[signature] = fontPath
+
+        # Touched, copied or restored; only parse if the content differs
+        fingerprint = getFingerprint(fontPath)
+        if(cached is not None and fingerprint is not None and
+                cached[1].get('fingerprint') == fingerprint):
+            metaCache[fontPath] = (signature, cached[1])
+            continue
+
+        fingerprints[fontPath] = fingerprint
+        toDigest.append(fontPath)
+
+    failedDigests = {}
+    digests = {}
+    pending = toDigest
+    memberFailuresChanged = False
+
+    for attempt in range(snapshotRetries + 1):
+        if(attempt > 0):
+            time.sleep(snapshotRetryDelay)
+
+            for fontPath in list(pending):
+                try:
+                    signatures[fontPath] = getStatSignature(os.stat(fontPath))
+                except OSError:
+                    del signatures[fontPath]
+                    pending.remove(fontPath)
+                    continue
+                fingerprints[fontPath] = getFingerprint(fontPath)
+
+        digests.update(getDigests(pending, signatures))
+
+        toExtract = []
+        extractDigests = set()
+
+        for fontPath in pending:
+            digest = digests[fontPath]
+
+            if(digest in digestIndex or digest in extractDigests):
+                sharedDigests.add(digest)
+            elif(digest is not None):
+                extractDigests.add(digest)
+                toExtract.append(fontPath)
+
+        drifted = set()
+
+        for fontPath, fontMeta, error in extractAll(toExtract, signatures):
+            # Changed since it was first stat'ed, so possibly read half written
+            if(hasDrifted(fontPath, signatures[fontPath])):
+                drifted.add(fontPath)
+                continue
+
+            if(error is not None):
+                failedDigests[digests[fontPath]] = error
+                continue
+
+            fillFromFontconfig(fontPath, fontMeta)
+
+            if(fingerprints[fontPath] is not None):
+                fontMeta['fingerprint'] = fingerprints[fontPath]
+            fontMeta['digest'] = digests[fontPath]
+
+            digestIndex[fontMeta['digest']] = fontMeta
+            metaCache[fontPath] = (signatures[fontPath], fontMeta)
+
+            if(isCheckpointDue()):
+                writeCheckpoint()
+
+        # Fan the parsed metadata out to every path with the same content
+        extracted = set(toExtract)
+        for fontPath in pending:
+            if(fontPath in drifted or
+                    fontPath not in extracted and hasDrifted(fontPath, signatures[fontPath])):
+                drifted.add(fontPath)
+                continue
+
+            digest = digests[fontPath]
+            fontMeta = digestIndex.get(digest)
+
+            if(fontMeta is not None):
+                metaCache[fontPath] = (signatures[fontPath], fontMeta)
+                failureRecord.pop(fontPath, None)
+                memberFailuresChanged |= recordMemberFailures(
+                    fontPath, signatures[fontPath], fontMeta)
+            elif(digest in failedDigests):
+                metaCache.pop(fontPath, None)
+                recordFailure(fontPath, signatures[fontPath], failedDigests[digest])
+            elif(digest is not None):
+                # The copy which was parsed changed while being read
+                drifted.add(fontPath)
+            else:
+                metaCache.pop(fontPath, None)
+
+        pending = [fontPath for fontPath in pending if fontPath in drifted]
+        if(not pending):
+            break
+
+    for fontPath in pending:
+        print(f"File '{fontPath}' keeps changing while being read, deferring it")
+        deferredPaths[fontPath] = scanGeneration
+
+    # and to every other name for the same file
+    for fontPath, aliasedPath in aliases.items():
+        if(deferredPaths.get(aliasedPath) == scanGeneration):
+            deferredPaths[fontPath] = scanGeneration
+            continue
+
+        # The same file, so if it was stat'ed again while re-reading it this
+        # name has the new signature too
+        signatures[fontPath] = signatures.get(aliasedPath, signatures[fontPath])
+        cached = metaCache.get(aliasedPath)
+
+        if(cached is None or cached[0] != signatures[fontPath]):
+            metaCache.pop(fontPath, None)
+            if(aliasedPath in failureRecord):
+                recordFailure(fontPath, signatures[fontPath],
+                              failureRecord[aliasedPath]['reason'])
+        else:
+            metaCache[fontPath] = cached
+            failureRecord.pop(fontPath, None)
+
+    if(failedDigests or memberFailuresChanged or len(failureRecord) != failureCount):
+        updateFailureRecord(failureRecord)
+
+    # Keep the order the paths were given in regardless of completion order
     fontsMeta = {}
-    for fontPath in getFontPaths():
-        fontsMeta[fontPath] = FontMeta(fontPath).get_data()
+    for fontPath, signature in signatures.items():
+        cached = metaCache.get(fontPath)
+        if(cached is None):
+            continue
+
+        if(cached[0] == signature):
+            signatureIndex[signature] = cached[1]
+        elif(deferredPaths.get(fontPath) != scanGeneration):
+            continue
+
+        fontsMeta.update(packRecords(fontPath, cached[1]))
+
+    for fontPath in [fontPath for fontPath, generation in deferredPaths.items()
+                     if generation != scanGeneration]:
+        del deferredPaths[fontPath]
 
     return fontsMeta
 
 
+def iterCurrentMeta(isHeld=None):
+    """Yields (recordPath, fontMeta) for every font, streaming the scan
+
+    Files are read streamBatchSize at a time as the walk finds them, so
+    the first fonts are yielded long before the walk is over. The caches
+    are only pruned once the generator has been exhausted. Files for which
+    isHeld, if given, returns True are left unread and not yielded.
+
+    Only the results are streamed: metaCache, its indexes and sniffCache
+    keep an entry per font between scans, and the paths walked are kept
+    until the end of the scan to prune them."""
+
+    global lastCheckpoint
+
+    filePaths = set()
+    batch = []
+
+    loadMetaCache()
+
+    # Only full scans are checkpointed, and only once they have run for a while
+    lastCheckpoint = time.monotonic()
+    try:
+        for filePath in getFontPaths():
+            filePaths.add(filePath)
+            if(isHeld is not None and isHeld(filePath)):
+                continue
+
+            batch.append(filePath)
+
+            if(len(batch) >= streamBatchSize):
+                yield from getMeta(batch).items()
+                batch = []
+
+        yield from getMeta(batch).items()
+    finally:
+        lastCheckpoint = None
+
+    # Forget files which have disappeared so the caches do not grow unbounded
+    for stalePath in sniffCache.keys() - filePaths:
+        del sniffCache[stalePath]
+
+    for stalePath in metaCache.keys() - filePaths:
+        del metaCache[stalePath]
+
+    # Signatures of files since changed or removed are only dropped here
+    signatureIndex.clear()
+    for signature, fontMeta in metaCache.values():
+        if(signature is not None):
+            signatureIndex[signature] = fontMeta
+
+    digestCounts = collections.Counter(fontMeta.get('digest')
+                                       for signature, fontMeta in metaCache.values())
+    for staleDigest in digestIndex.keys() - digestCounts.keys():
+        del digestIndex[staleDigest]
+
+    # A digest may only have been seen again for the file's own earlier
+    # content, or for a file since moved
+    for digest in sharedDigests:
+        if(digestCounts[digest] > 1):
+            print(f"{digestCounts[digest]} files share the content {digest}")
+    sharedDigests.clear()
+
+    staleFailures = [failedPath for failedPath, failure in failureRecord.items()
+                     if failure.get('file', failedPath) not in filePaths]
+    if(staleFailures):
+        for stalePath in staleFailures:
+            del failureRecord[stalePath]
+        updateFailureRecord(failureRecord)
+
+    if(failureRecord):
+        print(f"{len(failureRecord)} fonts could not be read")
+
+    # The scan finished, so the records are now complete
+    removeCheckpoint()
+
+
+def getCurrentMeta():
+    """Returns a dict containing font metadata in a {recordPath: fontMeta} format"""
+
+    return dict(iterCurrentMeta())
+
+
+# inotify(7) event bits
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+inotifyEventHeader = struct.Struct('iIII')
+
+
+class FontWatcher:
+    """Watches font directories recursively with inotify and reports changed paths"""
+
+    watchMask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+                 IN_ONLYDIR)
+
+    def __init__(self, fontDirs):
+        """Raises OSError if inotify is unavailable or its limits are exhausted"""
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if(self.fd < 0):
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.fontDirs = list(fontDirs)
+        self.watches = {}
+
+        try:
+            for fontDir in self.fontDirs:
+                self.addTree(fontDir)
+        except OSError:
+            self.close()
+            raise
+
+    def addWatch(self, dirPath):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(dirPath), self.watchMask)
+
+        if(wd < 0):
+            err = ctypes.get_errno()
+            # The directory may vanish or be unreadable; only running out of
+            # watches is fatal since we would silently miss changes
+            if(err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES)):
+                return
+            raise OSError(err, os.strerror(err), dirPath)
+
+        self.watches[wd] = dirPath
+
+    def addTree(self, rootDir):
+        if(isExcludedDir(rootDir)):
+            return
+
+        for dirPath, subDirNames, fileNames in os.walk(rootDir):
+            self.addWatch(dirPath)
+
+            # Same pruning as walkFontPaths, so excluded trees cost no watches
+            subDirNames[:] = [subDirName for subDirName in subDirNames
+                              if not isExcludedDir(os.path.join(dirPath, subDirName))]
+            if(maxScanDepth is not None and getDirDepth(dirPath) >= maxScanDepth):
+                subDirNames[:] = []
+
+    def readChanges(self):
+        """Returns the set of paths touched by all pending events"""
+
+        changedPaths = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, nameLen = inotifyEventHeader.unpack_from(
+                    data, offset)
+                offset += inotifyEventHeader.size
+                name = data[offset:offset + nameLen].rstrip(b'\0')
+                offset += nameLen
+
+                if(mask & IN_Q_OVERFLOW):
+                    # Events were dropped, so everything has to be looked at
+                    changedPaths.update(self.fontDirs)
+                    continue
+
+                if(mask & IN_IGNORED):
+                    self.watches.pop(wd, None)
+                    continue
+
+                dirPath = self.watches.get(wd)
+                if(dirPath is None):
+                    continue
+
+                path = os.path.join(dirPath, os.fsdecode(name)) if name else dirPath
+                changedPaths.add(path)
+
+                if(mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)):
+                    self.addTree(path)
+
+        return changedPaths
+
+    def waitForChanges(self, timeout):
+        """Blocks for up to timeout seconds and returns the set of changed paths"""
+
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if(not readable):
+            return set()
+
+        return self.readChanges()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeDebouncer:
+    """Holds changed paths until their stat signatures have been stable for a while"""
+
+    def __init__(self, window, maxHold):
+        self.window = window
+        self.maxHold = maxHold
+        self.held = {}
+        self.firstChange = None
+        self.lastChange = None
+
+    def getSignature(self, path):
+        try:
+            return getStatSignature(os.stat(path))
+        except OSError:
+            return None
+
+    def add(self, paths):
+        """Holds the given paths, restarting the window if any is new or changed"""
+
+        now = time.monotonic()
+
+        for path in paths:
+            signature = self.getSignature(path)
+            if(path in self.held and self.held[path] == signature):
+                continue
+
+            self.held[path] = signature
+            self.lastChange = now
+            if(self.firstChange is None):
+                self.firstChange = now
+
+    def release(self):
+        """Returns and forgets all held paths once none has changed for the
+        window, or the set of no paths while they are still settling"""
+
+        if(not self.held):
+            return set()
+
+        # Writes do not all raise events, so the files themselves are checked too
+        self.add(list(self.held))
+
+        now = time.monotonic()
+        if(now - self.lastChange < self.window and now - self.firstChange < self.maxHold):
+            return set()
+
+        paths = set(self.held)
+        self.held = {}
+        self.firstChange = None
+        self.lastChange = None
+        return paths
+
+    def isHeld(self, path):
+        """Returns True if the path or a directory above it is being held"""
+
+        while True:
+            if(path in self.held):
+                return True
+
+            parentPath = os.path.dirname(path)
+            if(parentPath == path):
+                return False
+            path = parentPath
+
+    def secondsToRelease(self):
+        """Returns how long release() is worth waiting for, inf if nothing is held"""
+
+        if(not self.held):
+            return float('inf')
+
+        now = time.monotonic()
+        return max(0, min(self.lastChange + self.window, self.firstChange + self.maxHold) - now)
+
+
+def getChangeDebouncer():
+    """Returns the debouncer holding changed paths, creating it on first use"""
+
+    global changeDebouncer
+
+    if(changeDebouncer is None):
+        changeDebouncer = ChangeDebouncer(quiescenceSeconds, quiescenceMaxHoldSeconds)
+
+    return changeDebouncer
+
+
 def readMetaRecord():
     try:
 
@@ -68,98 +2318,230 @@ def updateMetaRecord(newMeta):
         json.dump(newMeta, f)
 
 
+def streamMetaRecord(records):
+    """Passes (recordPath, fontMeta) pairs through while writing them out as
+    the new meta record, which replaces the old one once all were written"""
+
+    with open(metaRecordPath + '.tmp', 'w') as f:
+        f.write('{')
+
+        separator = ''
+        for recordPath, fontMeta in records:
+            f.write(f"{separator}{json.dumps(recordPath)}: {json.dumps(fontMeta)}")
+            separator = ', '
+
+            yield recordPath, fontMeta
+
+        f.write('}')
+
+    os.replace(metaRecordPath + '.tmp', metaRecordPath)
+
+
+def readDirRecord():
+    try:
+
+        with open(dirRecordPath, 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+
+def updateDirRecord(newRecord):
+
+    with open(dirRecordPath, 'w') as f:
+        json.dump(newRecord, f)
+
+
+def readFailureRecord():
+    try:
+
+        with open(failureRecordPath, 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+
+def updateFailureRecord(newRecord):
+
+    with open(failureRecordPath, 'w') as f:
+        json.dump(newRecord, f)
+
+
 validMetaKeys = list(Font.attribute_map.keys())
 validMetaKeys.remove('user_name')
 validMetaKeys.remove('font_path')
 
+# {nameId: metaKey} for the name table entries FontMeta reports under validMetaKeys
+metaNameIds = {nameId: field.lower().replace(' ', '_')
+               for nameId, field in NAME_TABLE.items()
+               if field.lower().replace(' ', '_') in validMetaKeys}
+
 
 def getPrepMeta(meta, user, path):
     newMeta = {key: meta.get(key, '') for key in validMetaKeys}
 
-    return Font(user_name=user, font_path=path, **newMeta)
+    return Font(user_name=getFontUser(path, user), font_path=path, **newMeta)
 
 
-def reportChanges(user_name, config):
-    """Check for changes in all font metadata and report accordingly"""
+def sendChanges(user_name, config, oldMeta, newMeta):
+    """Report the differences between two metadata snapshots and record the new one"""
 
-    oldMeta = readMetaRecord()
-    newMeta = getCurrentMeta()
+    if(oldMeta == newMeta):
+        return
+
+    print("Meta has changed!")
 
     with openapi_client.ApiClient(config) as apiClient:
 
         apiInstance = default_api.DefaultApi(apiClient)
 
-        validKeys = Font.attribute_map.keys()
+        oldPaths = set(oldMeta.keys())
+        newPaths = set(newMeta.keys())
 
-        if(oldMeta != newMeta):
-            print("Meta has changed!")
+        for addedPath in newPaths - oldPaths:
 
-            oldPaths = set(oldMeta.keys())
-            newPaths = set(newMeta.keys())
+            print(f"File '{addedPath}' has been added!")
 
-            for addedPath in newPaths - oldPaths:
+            cMeta = newMeta[addedPath]
+            font = getPrepMeta(cMeta, user_name, addedPath)
 
-                print(f"File '{addedPath}' has been added!")
+            try:
+                apiResponse = apiInstance.create_font_font_post(font)
+                #print(apiResponse)
+            except openapi_client.exceptions.ApiException as e:
+                print(e.body)
 
-                cMeta = newMeta[addedPath]
-                font = getPrepMeta(cMeta, user_name, addedPath)
+        for removedPath in oldPaths - newPaths:
+            print(f"File '{removedPath}' has been removed!")
 
-                try:
-                    apiResponse = apiInstance.create_font_font_post(font)
-                    #print(apiResponse)
-                except openapi_client.exceptions.ApiException as e:
-                    print(e.body)
+            cMeta = oldMeta[removedPath]
+            font = getPrepMeta(cMeta, user_name, removedPath)
+
+            try:
+                apiResponse = apiInstance.remove_font_font_delete(font)
+            except openapi_client.exceptions.ApiException as e:
+                print(e.body)
 
-            for removedPath in oldPaths - newPaths:
-                print(f"File '{removedPath}' has been removed!")
+        for samePath in newPaths & oldPaths:
+            if(oldMeta[samePath] != newMeta[samePath]):
+                print(f"File '{samePath}' has been modified!")
+
+                cMeta = newMeta[samePath]
+                font = getPrepMeta(cMeta, user_name, samePath)
 
-                cMeta = newMeta[removedPath]
-                font = getPrepMeta(cMeta, user_name, removedPath)
-                
                 try:
-                    apiResponse = apiInstance.remove_font_font_delete(font)
+                    apiResponse = apiInstance.update_font_font_put(font)
                 except openapi_client.exceptions.ApiException as e:
                     print(e.body)
 
-            for samePath in newPaths & oldPaths:
-                if(oldMeta[samePath] != newMeta[samePath]):
-                    print(f"File '{samePath}' has been modified!")
+    updateMetaRecord(newMeta)
 
-                    cMeta = newMeta[samePath]
-                    font = getPrepMeta(cMeta, user_name, samePath)
 
-                    try:
-                        apiResponse = apiInstance.update_font_font_put(font)
-                    except openapi_client.exceptions.ApiException as e:
-                        print(e.body)
+def reportChanges(user_name, config):
+    """Check for changes in all font metadata and report accordingly"""
 
-            updateMetaRecord(newMeta)
+    debouncer = getChangeDebouncer()
 
+    oldMeta = readMetaRecord()
+    newMeta = getCurrentMeta()
 
-def reportAll(user_name, config):
-    """Report full account of all font metadata"""
+    changedPaths = {getRecordFile(recordPath, newMeta.get(recordPath) or oldMeta[recordPath])
+                    for recordPath in oldMeta.keys() | newMeta.keys()
+                    if oldMeta.get(recordPath) != newMeta.get(recordPath)}
+    debouncer.add(changedPaths)
 
-    print("Reporting all!")
+    # Until the changes settle the record stays as it was, so they are seen again
+    if(not debouncer.release()):
+        return
 
-    cMetas = getCurrentMeta()
+    sendChanges(user_name, config, oldMeta, newMeta)
 
-    # Talk to REST API
+
+def reportPathChanges(user_name, config, changedPaths):
+    """Check for changes in font metadata below the given paths only"""
+
+    oldMeta = readMetaRecord()
+    newMeta = dict(oldMeta)
+    fontPaths = []
+
+    for changedPath in changedPaths:
+
+        # Anything recorded at or below the path is re-established from disk
+        prefix = os.path.join(changedPath, '')
+        for recordedPath, recordedMeta in list(newMeta.items()):
+            recordedFile = getRecordFile(recordedPath, recordedMeta)
+            if(recordedFile == changedPath or recordedFile.startswith(prefix)):
+                del newMeta[recordedPath]
+
+        if(os.path.isdir(changedPath)):
+            if(not isExcludedDir(changedPath)):
+                fontPaths.extend(walkFontPaths([changedPath]))
+        elif(os.path.isfile(changedPath) and isWithinPolicy(changedPath)):
+            fontPaths.append(changedPath)
+
+    changedMeta = getMeta(fontPaths)
+    newMeta.update(changedMeta)
+
+    readPaths = {getRecordFile(recordPath, recordMeta)
+                 for recordPath, recordMeta in changedMeta.items()}
+    for fontPath in set(fontPaths) - readPaths - changedMeta.keys():
+        # Possibly still being written; keep what we knew before
+        for recordedPath, recordedMeta in oldMeta.items():
+            if(isRecordOf(recordedPath, recordedMeta, fontPath)):
+                newMeta[recordedPath] = recordedMeta
+
+    sendChanges(user_name, config, oldMeta, newMeta)
+
+
+def upsertFonts(user_name, config, fontsMeta):
+    """Send the given font metadata to the server, creating or replacing entries"""
 
     res = []
-    for path, cMeta in cMetas.items():
+    for path, cMeta in fontsMeta.items():
         res.append(getPrepMeta(cMeta, user_name, path))
 
     with openapi_client.ApiClient(config) as apiClient:
-        
+
         apiInstance = default_api.DefaultApi(apiClient)
-        
+
         try:
             apiInstance.upsert_fonts_fonts_upsert_post(res)
         except openapi_client.exceptions.ApiException as e:
             print(e.body)
 
 
-    updateMetaRecord(cMetas)
+def reportAll(user_name, config):
+    """Report full account of all font metadata"""
+
+    print("Reporting all!")
+
+    # Fonts still changing are left to the debouncer; what was recorded of
+    # them is kept as it is
+    debouncer = getChangeDebouncer()
+    heldMeta = {}
+    if(debouncer.held):
+        heldMeta = {path: cMeta for path, cMeta in readMetaRecord().items()
+                    if debouncer.isHeld(getRecordFile(path, cMeta))}
+
+    # Fonts are sent as the scan finds them, a bounded chunk at a time
+    chunk = {}
+    records = itertools.chain(iterCurrentMeta(isHeld=debouncer.isHeld), heldMeta.items())
+    for path, cMeta in streamMetaRecord(records):
+        if(path in heldMeta):
+            continue
+
+        chunk[path] = cMeta
+
+        if(len(chunk) >= reportChunkSize):
+            upsertFonts(user_name, config, chunk)
+            chunk = {}
+
+    if(chunk):
+        upsertFonts(user_name, config, chunk)
 
 
 def do_setup():
@@ -177,15 +2559,49 @@ def do_setup():
 def main():
 
     user_name, config = do_setup()
-    
+
+    applyScanPolicy()
     print(getFontDirs())
 
-    schedule.every(5).seconds.do(reportChanges, user_name, config)
     schedule.every(30).seconds.do(reportAll, user_name, config)
 
+    watcher = None
+    if(sys.platform.startswith('linux')):
+        try:
+            watcher = FontWatcher(getFontDirs())
+        except OSError as e:
+            print(f"Unable to watch font directories ({e}), polling instead")
+
+    if(watcher is None):
+        schedule.every(5).seconds.do(reportChanges, user_name, config)
+
+    debouncer = getChangeDebouncer()
+
     while True:
         schedule.run_pending()
-        time.sleep(1)
+
+        if(watcher is None):
+            time.sleep(1)
+            continue
+
+        try:
+            changedPaths = watcher.waitForChanges(
+                min(schedule.idle_seconds(), debouncer.secondsToRelease()))
+        except OSError as e:
+            # Most likely out of watches for a new subdirectory
+            print(f"Unable to keep watching font directories ({e}), polling instead")
+            watcher.close()
+            watcher = None
+            schedule.every(5).seconds.do(reportChanges, user_name, config)
+            reportChanges(user_name, config)
+            continue
+
+        debouncer.add(changedPaths)
+
+        # A burst of changes is reported in one go once it is over
+        changedPaths = debouncer.release()
+        if(changedPaths):
+            reportPathChanges(user_name, config, changedPaths)
  
 
 if(__name__ == '__main__'):
@@ -0,0 +1,57 @@
+"""Shared fixtures for the tests, which need pytest on top of requirements.txt:
+
+    pip install -r requirements.txt pytest
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+# main.py lives at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def fontDir(tmp_path, monkeypatch):
+    """Returns the only font directory scans see, with the records kept in
+    tmp_path and every cache of main starting out empty"""
+
+    fontDir = str(tmp_path / 'fonts')
+    os.mkdir(fontDir)
+    monkeypatch.chdir(tmp_path)
+
+    for name, value in {'metaCache': None, 'signatureIndex': {}, 'digestIndex': {},
+                        'sharedDigests': set(), 'sniffCache': {}, 'failureRecord': None,
+                        'dirRecord': None, 'deferredPaths': {}, 'scanGeneration': 0,
+                        'lastCheckpoint': None, 'changeDebouncer': None, 'pathMatchers': None,
+                        'includeGlobs': [], 'excludeGlobs': [], 'maxScanDepth': None,
+                        'maxFontSize': None, 'snapshotRetryDelay': 0,
+                        'fontDirOwners': {fontDir: None}}.items():
+        monkeypatch.setattr(main, name, value)
+
+    monkeypatch.setattr(main, 'getFontDirs', lambda: [fontDir])
+
+    return fontDir
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    """Replaces parsing with a stub reporting what follows a file's magic
+    bytes as its family, and returns the list of paths it was asked to parse"""
+
+    extracted = []
+
+    def extractAll(fontPaths, signatures):
+        for fontPath in fontPaths:
+            extracted.append(fontPath)
+            with open(fontPath, 'rb') as f:
+                family = f.read()[4:].decode()
+            yield fontPath, {'font_family': family}, None
+
+    monkeypatch.setattr(main, 'extractAll', extractAll)
+
+    return extracted
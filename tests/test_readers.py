@@ -0,0 +1,180 @@
+"""Cross-checks the fast name table readers against FontMeta on generated fonts"""
+
+import struct
+import zipfile
+
+import pytest
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTCollection
+
+from fontmeta import FontMeta
+
+import main
+
+
+def buildFont(family, style='Regular', instances=None):
+    """Returns a minimal TrueType font with every reported name filled in,
+    made a variable font with the given named instances if any"""
+
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(['.notdef'])
+    fb.setupCharacterMap({})
+    fb.setupGlyf({'.notdef': TTGlyphPen(None).glyph()})
+    fb.setupHorizontalMetrics({'.notdef': (500, 0)})
+    fb.setupHorizontalHeader()
+    fb.setupNameTable({
+        'copyright': f"Copyright {family} Authors",
+        'familyName': family,
+        'styleName': style,
+        'uniqueFontIdentifier': f"{family}-{style};1.000",
+        'version': "Version 1.000",
+        'manufacturer': "Font Foundry",
+        'licenseDescription': "Licensed under the Open Font License",
+    })
+    fb.setupOS2()
+    fb.setupPost()
+
+    if(instances):
+        axes = [('wght', 100, 400, 900, 'Weight'), ('wdth', 75, 100, 100, 'Width')]
+        fb.setupFvar(axes, [dict(location=location, stylename=name)
+                            for name, location in instances])
+
+    return fb.font
+
+
+def readFontMetaLegacy(fontPath):
+    """Full FontMeta parse trimmed to the reported fields"""
+
+    fontMeta = FontMeta(fontPath).get_data()
+    return {key: fontMeta[key] for key in main.validMetaKeys if key in fontMeta}
+
+
+def saveFont(font, path, flavor=None):
+    font.flavor = flavor
+    font.save(str(path))
+    return str(path)
+
+
+def saveCollection(fonts, path):
+    collection = TTCollection()
+    collection.fonts = fonts
+    collection.save(str(path))
+    return str(path)
+
+
+def test_sfnt_matches_fontmeta(tmp_path):
+    fontPath = saveFont(buildFont('Plain'), tmp_path / 'plain.ttf')
+
+    fontMeta = main.readFontMeta(fontPath)
+
+    assert fontMeta == readFontMetaLegacy(fontPath)
+    assert fontMeta['font_family'] == 'Plain'
+    assert set(fontMeta) == set(main.validMetaKeys)
+
+
+def test_woff_matches_fontmeta(tmp_path):
+    fontPath = saveFont(buildFont('Web'), tmp_path / 'web.woff', flavor='woff')
+
+    assert main.readFontMeta(fontPath) == readFontMetaLegacy(fontPath)
+
+
+def test_collection_reports_every_face(tmp_path):
+    fonts = [buildFont('First'), buildFont('Second', 'Bold')]
+    fontPath = saveCollection(fonts, tmp_path / 'pack.ttc')
+
+    # FontMeta cannot read collections, so faces are checked against the lone fonts
+    facePaths = [saveFont(font, tmp_path / f"face{faceIndex}.ttf")
+                 for faceIndex, font in enumerate(fonts)]
+
+    faces = main.readFontMeta(fontPath)['faces']
+
+    assert [faceMeta.pop('face') for faceMeta in faces] == [0, 1]
+    assert faces == [readFontMetaLegacy(facePath) for facePath in facePaths]
+
+
+def test_variable_font_reports_named_instances(tmp_path):
+    instances = [('Light', {'wght': 300, 'wdth': 100}),
+                 ('Bold Condensed', {'wght': 700, 'wdth': 75}),
+                 ('Regular', {'wght': 400, 'wdth': 100})]
+    font = buildFont('Vary', instances=instances)
+
+    for fontPath in (saveFont(font, tmp_path / 'vary.ttf'),
+                     saveFont(font, tmp_path / 'vary.woff', flavor='woff')):
+        fontMeta = main.readFontMeta(fontPath)
+
+        assert fontMeta.pop('instances') == ['Light', 'Bold Condensed', 'Regular']
+        assert fontMeta == readFontMetaLegacy(fontPath)
+
+
+def test_variable_font_records_share_the_digest(tmp_path):
+    instances = [('Light', {'wght': 300, 'wdth': 100}),
+                 ('Bold', {'wght': 700, 'wdth': 100})]
+    fontPath = saveFont(buildFont('Vary', instances=instances), tmp_path / 'vary.ttf')
+
+    fontMeta = dict(main.readFontMeta(fontPath), digest='d')
+    records = main.packRecords(fontPath, fontMeta)
+
+    assert list(records) == [f"{fontPath}@Light", f"{fontPath}@Bold"]
+    assert {recordMeta['digest'] for recordMeta in records.values()} == {'d'}
+    assert main.unpackRecords(records) == {fontPath: fontMeta}
+    assert all(main.getRecordFile(recordPath, recordMeta) == fontPath
+               for recordPath, recordMeta in records.items())
+
+
+def test_zip_reports_font_members(tmp_path):
+    plainPath = saveFont(buildFont('Plain'), tmp_path / 'plain.ttf')
+    webPath = saveFont(buildFont('Web'), tmp_path / 'web.woff', flavor='woff')
+    packPath = saveCollection([buildFont('First'), buildFont('Second')], tmp_path / 'pack.ttc')
+
+    bundlePath = str(tmp_path / 'bundle.zip')
+    with zipfile.ZipFile(bundlePath, 'w') as bundle:
+        bundle.write(plainPath, 'fonts/plain.ttf', compress_type=zipfile.ZIP_DEFLATED)
+        bundle.write(webPath, 'fonts/web.woff', compress_type=zipfile.ZIP_STORED)
+        bundle.write(packPath, 'pack.ttc', compress_type=zipfile.ZIP_DEFLATED)
+        bundle.writestr('readme.txt', 'not a font')
+
+    members = {memberMeta.pop('member'): memberMeta
+               for memberMeta in main.readFontMeta(bundlePath)['members']}
+
+    assert list(members) == ['fonts/plain.ttf', 'fonts/web.woff', 'pack.ttc#0', 'pack.ttc#1']
+    assert members['fonts/plain.ttf'] == readFontMetaLegacy(plainPath)
+    assert members['fonts/web.woff'] == readFontMetaLegacy(webPath)
+    assert [members[name]['font_family'] for name in ('pack.ttc#0', 'pack.ttc#1')] == \
+        ['First', 'Second']
+
+
+def test_truncated_font_is_unsupported(tmp_path):
+    fontPath = saveFont(buildFont('Plain'), tmp_path / 'plain.ttf')
+    with open(fontPath, 'r+b') as f:
+        f.truncate(64)
+
+    # extractMeta() falls back to FontMeta on either
+    with pytest.raises((main.UnsupportedFont, struct.error)):
+        main.readFontMeta(fontPath)
+
+
+def test_zip_member_failures_spare_the_rest(tmp_path):
+    plainPath = saveFont(buildFont('Plain'), tmp_path / 'plain.ttf')
+
+    bundlePath = str(tmp_path / 'bundle.zip')
+    with zipfile.ZipFile(bundlePath, 'w') as bundle:
+        bundle.write(plainPath, 'odd.ttf')
+        bundle.write(plainPath, 'plain.ttf')
+        bundle.writestr('broken.ttf', b'\x00\x01\x00\x00' + bytes(8))
+
+    # Claim a compression method zipfile does not implement for the first member
+    with zipfile.ZipFile(bundlePath) as bundle:
+        info = bundle.getinfo('odd.ttf')
+    with open(bundlePath, 'r+b') as f:
+        data = bytearray(f.read())
+        struct.pack_into('<H', data, info.header_offset + 8, 99)
+        struct.pack_into('<H', data, data.index(b'PK\x01\x02') + 10, 99)
+        f.seek(0)
+        f.write(data)
+
+    fontMeta = main.readFontMeta(bundlePath)
+
+    assert [memberMeta['member'] for memberMeta in fontMeta['members']] == ['plain.ttf']
+    assert sorted(fontMeta['failures']) == ['broken.ttf', 'odd.ttf']
+    assert fontMeta['failures']['odd.ttf'].startswith('NotImplementedError')
@@ -0,0 +1,17 @@
+"""Checks how font files map to the records reported for them"""
+
+import main
+
+
+def test_records_belong_to_their_file_only():
+    records = main.packRecords('/d/Font', {'faces': [{'face': 0}, {'face': 1}]})
+    records['/d/Font@2x.ttf'] = {}
+    records['/d/Font#2.ttf'] = {}
+    records['/d/bundle.zip!Font'] = {'member': 'Font'}
+
+    assert [recordPath for recordPath, recordMeta in records.items()
+            if main.isRecordOf(recordPath, recordMeta, '/d/Font')] == \
+        ['/d/Font#0', '/d/Font#1']
+    assert [recordPath for recordPath, recordMeta in records.items()
+            if main.isRecordOf(recordPath, recordMeta, '/d/bundle.zip')] == \
+        ['/d/bundle.zip!Font']
@@ -0,0 +1,236 @@
+"""Runs whole scans over a temporary font directory with parsing stubbed out"""
+
+import os
+
+import main
+
+
+def writeFont(path, content=b''):
+    """Writes a file that sniffs as a TrueType font"""
+
+    with open(path, 'wb') as f:
+        f.write(b'\x00\x01\x00\x00' + (content or os.path.basename(path).encode()))
+
+    return path
+
+
+def resetCaches(monkeypatch):
+    """Forgets everything but the records on disk, as a restarted agent would"""
+
+    for name, value in {'metaCache': None, 'signatureIndex': {}, 'digestIndex': {},
+                        'sniffCache': {}, 'failureRecord': None, 'dirRecord': None}.items():
+        monkeypatch.setattr(main, name, value)
+
+
+def test_interrupted_scan_resumes_from_checkpoint(fontDir, extracted, monkeypatch):
+    fontPaths = [writeFont(os.path.join(fontDir, f"font{i}.ttf")) for i in range(4)]
+
+    # Checkpoint after every font and stop half way through
+    monkeypatch.setattr(main, 'checkpointInterval', 0)
+    monkeypatch.setattr(main, 'streamBatchSize', 1)
+    scan = main.iterCurrentMeta()
+    firstPaths = [next(scan)[0], next(scan)[0]]
+    scan.close()
+
+    assert os.path.exists(main.checkpointPath)
+
+    # The walk falls due for a checkpoint before the first batch is read
+    resetCaches(monkeypatch)
+    monkeypatch.setattr(main, 'streamBatchSize', 256)
+    extracted.clear()
+
+    assert sorted(main.getCurrentMeta()) == sorted(fontPaths)
+    assert sorted(extracted) == sorted(set(fontPaths) - set(firstPaths))
+    assert not os.path.exists(main.checkpointPath)
+
+
+def test_debouncer_waits_for_quiet_window(fontDir, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: clock[0])
+    fontPath = writeFont(os.path.join(fontDir, 'font.ttf'))
+    debouncer = main.ChangeDebouncer(2, 60)
+
+    debouncer.add([fontPath])
+    clock[0] = 1
+    assert debouncer.release() == set()
+
+    # Another write restarts the window
+    writeFont(fontPath, b'longer content')
+    clock[0] = 2.5
+    assert debouncer.release() == set()
+
+    clock[0] = 4.5
+    assert debouncer.release() == {fontPath}
+    assert not debouncer.held
+
+
+def test_debouncer_releases_after_max_hold(fontDir, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: clock[0])
+    fontPath = writeFont(os.path.join(fontDir, 'font.ttf'))
+    debouncer = main.ChangeDebouncer(2, 5)
+    debouncer.add([fontPath])
+
+    # Written to every second, so the window never passes quietly
+    for second in range(1, 5):
+        clock[0] = second
+        writeFont(fontPath, b'x' * second)
+        assert debouncer.release() == set()
+
+    clock[0] = 5
+    writeFont(fontPath, b'x' * 5)
+    assert debouncer.release() == {fontPath}
+
+
+def test_debouncer_holds_paths_below_held_directories(fontDir):
+    debouncer = main.ChangeDebouncer(2, 60)
+    debouncer.add([os.path.join(fontDir, 'new')])
+
+    assert debouncer.isHeld(os.path.join(fontDir, 'new'))
+    assert debouncer.isHeld(os.path.join(fontDir, 'new', 'sub', 'font.ttf'))
+    assert not debouncer.isHeld(os.path.join(fontDir, 'newer', 'font.ttf'))
+    assert not debouncer.isHeld(fontDir)
+
+
+def test_report_all_leaves_held_fonts_as_recorded(fontDir, extracted, monkeypatch):
+    upserted = {}
+    monkeypatch.setattr(main, 'upsertFonts',
+                        lambda user_name, config, fontsMeta: upserted.update(fontsMeta))
+    stablePath = writeFont(os.path.join(fontDir, 'stable.ttf'))
+    changingPath = writeFont(os.path.join(fontDir, 'changing.ttf'))
+
+    main.reportAll('user', None)
+    recorded = main.readMetaRecord()
+
+    assert sorted(upserted) == sorted([stablePath, changingPath])
+
+    writeFont(changingPath, b'half written')
+    main.getChangeDebouncer().add([changingPath])
+    upserted.clear()
+    extracted.clear()
+
+    main.reportAll('user', None)
+
+    assert list(upserted) == [stablePath]
+    assert extracted == []
+    assert main.readMetaRecord()[changingPath] == recorded[changingPath]
+
+
+def listWalk(monkeypatch):
+    """Returns the files a walk yields and the directories it listed"""
+
+    listedDirs = []
+    scanDir = main.scanDir
+
+    def listDir(dirPath, known=None):
+        listedDirs.append(dirPath)
+        return scanDir(dirPath, known)
+
+    monkeypatch.setattr(main, 'scanDir', listDir)
+
+    return sorted(main.getFontPaths()), sorted(listedDirs)
+
+
+def test_excluded_directories_are_not_listed(fontDir, monkeypatch):
+    os.makedirs(os.path.join(fontDir, 'backup', 'old'))
+    fontPath = writeFont(os.path.join(fontDir, 'font.ttf'))
+    writeFont(os.path.join(fontDir, 'backup', 'old', 'font.ttf'))
+    monkeypatch.setattr(main, 'excludeGlobs', ['*/backup/*'])
+
+    assert listWalk(monkeypatch) == ([fontPath], [fontDir])
+
+
+def test_excluded_root_is_not_walked(fontDir, monkeypatch):
+    writeFont(os.path.join(fontDir, 'font.ttf'))
+    monkeypatch.setattr(main, 'excludeGlobs', [fontDir])
+
+    assert listWalk(monkeypatch) == ([], [])
+
+
+def test_walk_stops_at_max_depth(fontDir, monkeypatch):
+    subDir = os.path.join(fontDir, 'sub')
+    os.makedirs(os.path.join(subDir, 'deeper'))
+    fontPaths = [writeFont(os.path.join(fontDir, 'top.ttf')),
+                 writeFont(os.path.join(subDir, 'sub.ttf'))]
+    writeFont(os.path.join(subDir, 'deeper', 'deep.ttf'))
+    monkeypatch.setattr(main, 'maxScanDepth', 1)
+
+    assert listWalk(monkeypatch) == (sorted(fontPaths), [fontDir, subDir])
+    assert main.isWithinPolicy(fontPaths[1])
+    assert not main.isWithinPolicy(os.path.join(subDir, 'deeper', 'deep.ttf'))
+
+
+def test_font_changing_while_read_is_deferred(fontDir, extracted, monkeypatch):
+    fontPath = writeFont(os.path.join(fontDir, 'font.ttf'), b'Old')
+    assert main.getCurrentMeta()[fontPath]['font_family'] == 'Old'
+
+    # Every read finds the file rewritten behind it
+    extractAll = main.extractAll
+
+    def extractWhileWriting(fontPaths, signatures):
+        for fontPath, fontMeta, error in extractAll(fontPaths, signatures):
+            writeFont(fontPath, b'New' * len(extracted))
+            yield fontPath, fontMeta, error
+
+    writeFont(fontPath, b'Started')
+
+    monkeypatch.setattr(main, 'extractAll', extractWhileWriting)
+    extracted.clear()
+
+    assert main.getCurrentMeta()[fontPath]['font_family'] == 'Old'
+    assert len(extracted) == main.snapshotRetries + 1
+    assert fontPath in main.deferredPaths
+
+    monkeypatch.setattr(main, 'extractAll', extractAll)
+
+    assert main.getCurrentMeta()[fontPath]['font_family'] == 'New' * 3
+    assert fontPath not in main.deferredPaths
+
+
+def test_failed_font_backs_off(fontDir, extracted, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, 'time', lambda: clock[0])
+    extractAll = main.extractAll
+
+    def extractFailing(fontPaths, signatures):
+        for fontPath, fontMeta, error in extractAll(fontPaths, signatures):
+            yield fontPath, None, 'ValueError: broken'
+
+    monkeypatch.setattr(main, 'extractAll', extractFailing)
+    fontPath = writeFont(os.path.join(fontDir, 'font.ttf'), b'Broken')
+
+    assert main.getCurrentMeta() == {}
+    assert extracted == [fontPath]
+    retryAt = main.failureRecord[fontPath]['retryAt']
+
+    # The same bytes would fail the same way, however long ago that was
+    clock[0] = retryAt + 1
+    main.getCurrentMeta()
+    assert extracted == [fontPath]
+
+    clock[0] = 1000
+    writeFont(fontPath, b'Still broken')
+    main.getCurrentMeta()
+    assert extracted == [fontPath]
+
+    clock[0] = retryAt
+    main.getCurrentMeta()
+    assert extracted == [fontPath] * 2
+    assert main.failureRecord[fontPath]['failures'] == 2
+
+
+def test_shared_content_is_logged_once_per_scan(fontDir, extracted, capsys):
+    fontPaths = [writeFont(os.path.join(fontDir, f"copy{i}.ttf"), b'Same') for i in range(3)]
+    writeFont(os.path.join(fontDir, 'other.ttf'))
+
+    fontsMeta = main.getCurrentMeta()
+
+    assert len(extracted) == 2
+    assert fontsMeta[fontPaths[0]] is fontsMeta[fontPaths[2]]
+    assert capsys.readouterr().out.count('files share the content') == 1
+
+    # Moved rather than copied
+    os.rename(os.path.join(fontDir, 'other.ttf'), os.path.join(fontDir, 'moved.ttf'))
+    main.getCurrentMeta()
+
+    assert 'share the content' not in capsys.readouterr().out